@@ -1,5 +1,8 @@
 import logging
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, ChatJoinRequest, Message, Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -7,12 +10,33 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ChatJoinRequestHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    BaseRateLimiter,
+    ExtBot,
+    TypeHandler
 )
 import json
 import os
 import datetime
-from typing import Dict, List, Optional
+import sqlite3
+import threading
+import asyncio
+import bisect
+import functools
+import random
+import time
+import signal
+import multiprocessing
+import csv
+import gzip
+import heapq
+import io
+import itertools
+import pathlib
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
 # Configure logging
 logging.basicConfig(
@@ -26,10 +50,108 @@ USERS_FILE = 'users.json'
 CHANNELS_FILE = 'channels.json'
 ADMINS_FILE = 'admins.json'
 BROADCASTS_FILE = 'broadcasts.json'
+BROADCAST_JOBS_FILE = 'broadcast_jobs.json'
+
+# Storage backend: 'json' (in-memory with JSON files), 'journal' or 'sqlite'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+SQLITE_FILE = os.environ.get('SQLITE_FILE', 'bot.db')
+
+# Seconds a SQLite write waits for another process holding the write lock
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '30'))
+
+# Multi-process mode: with WORKER_PROCESSES > 0 this process only receives
+# updates and queues them in UPDATE_QUEUE_FILE, and that many worker processes
+# handle them. Updates are partitioned by user ID, so each user's updates are
+# handled in order by a single worker.
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '0'))
+UPDATE_QUEUE_FILE = os.environ.get('UPDATE_QUEUE_FILE', 'updates.db')
+UPDATE_BATCH_SIZE = int(os.environ.get('UPDATE_BATCH_SIZE', '100'))
+UPDATE_POLL_INTERVAL = float(os.environ.get('UPDATE_POLL_INTERVAL', '0.05'))
+
+# JSON storage write-behind: flush every N seconds or after N pending changes
+FLUSH_INTERVAL = float(os.environ.get('FLUSH_INTERVAL', '5'))
+FLUSH_THRESHOLD = int(os.environ.get('FLUSH_THRESHOLD', '500'))
+
+# Journal storage: append-only change log, compacted into the JSON files
+JOURNAL_FILE = os.environ.get('JOURNAL_FILE', 'journal.jsonl')
+COMPACT_INTERVAL = float(os.environ.get('COMPACT_INTERVAL', '300'))
+COMPACT_THRESHOLD = int(os.environ.get('COMPACT_THRESHOLD', '10000'))
+
+# Number of channels listed with their user counts in /stats
+STATS_TOP_CHANNELS = int(os.environ.get('STATS_TOP_CHANNELS', '20'))
+
+# Event loop lag sampling interval and warning threshold, in seconds
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_LAG_WARNING = float(os.environ.get('LOOP_LAG_WARNING', '0.1'))
+
+# Join request approval pipeline
+APPROVAL_WORKERS = int(os.environ.get('APPROVAL_WORKERS', '8'))
+APPROVAL_QUEUE_SIZE = int(os.environ.get('APPROVAL_QUEUE_SIZE', '10000'))
+APPROVAL_DRAIN_TIMEOUT = float(os.environ.get('APPROVAL_DRAIN_TIMEOUT', '30'))
+
+# Welcome DM queue: workers, queue bound and messages per second
+WELCOME_WORKERS = int(os.environ.get('WELCOME_WORKERS', '4'))
+WELCOME_QUEUE_SIZE = int(os.environ.get('WELCOME_QUEUE_SIZE', '10000'))
+WELCOME_RATE_LIMIT = float(os.environ.get('WELCOME_RATE_LIMIT', '10'))
+
+# Number of concurrent broadcast deliveries
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '25'))
+
+# Seconds between broadcast job checkpoints
+BROADCAST_CHECKPOINT_INTERVAL = float(os.environ.get('BROADCAST_CHECKPOINT_INTERVAL', '5'))
+
+# Seconds between broadcast progress message updates
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', '4'))
+
+# Users who blocked the bot or were deactivated are skipped by broadcasts and
+# re-probed once their last failure is this many days old
+REPROBE_AFTER_DAYS = float(os.environ.get('REPROBE_AFTER_DAYS', '30'))
+
+# Outgoing request limits: global per second, per private chat per second,
+# per group/channel per minute
+GLOBAL_RATE_LIMIT = float(os.environ.get('GLOBAL_RATE_LIMIT', '30'))
+CHAT_RATE_LIMIT = float(os.environ.get('CHAT_RATE_LIMIT', '1'))
+GROUP_RATE_LIMIT = float(os.environ.get('GROUP_RATE_LIMIT', '20'))
+
+# Bot API server. Point these at a self-hosted telegram-bot-api server to keep
+# traffic inside the network; with BOT_API_LOCAL the server runs in --local mode
+# and files up to 2000 MB can be uploaded instead of 50 MB.
+BOT_API_URL = os.environ.get('BOT_API_URL', 'https://api.telegram.org/bot')
+BOT_API_FILE_URL = os.environ.get('BOT_API_FILE_URL', 'https://api.telegram.org/file/bot')
+BOT_API_LOCAL = os.environ.get('BOT_API_LOCAL', '').lower() in ('1', 'true', 'yes')
+UPLOAD_LIMIT = (2000 if BOT_API_LOCAL else 50) * 1024 * 1024
+
+# /export: rows read from storage per batch, directory for the files while
+# they are written and sent, and the timeout for uploading one part
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', '5000'))
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+EXPORT_UPLOAD_TIMEOUT = float(os.environ.get('EXPORT_UPLOAD_TIMEOUT', '300'))
+
+# Rows written to storage per transaction by /import and the import CLI
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '5000'))
+
+# Prometheus metrics endpoint (0 disables it). Worker processes listen on
+# METRICS_PORT + their worker index.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8000'))
+
+# HTTP connection pools: update fetching, latency-sensitive calls (approvals,
+# admin replies) and bulk delivery (broadcasts, welcome DMs). The bulk pool
+# defaults to one connection per broadcast and welcome worker.
+UPDATES_POOL_SIZE = int(os.environ.get('UPDATES_POOL_SIZE', '1'))
+API_POOL_SIZE = int(os.environ.get('API_POOL_SIZE', '16'))
+BULK_POOL_SIZE = int(os.environ.get('BULK_POOL_SIZE', str(BROADCAST_CONCURRENCY + WELCOME_WORKERS)))
+POOL_TIMEOUT = float(os.environ.get('POOL_TIMEOUT', '30'))
+
+# Retry budget for Bot API calls; exhausted operations go to the dead-letter file
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '1'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '60'))
+DEAD_LETTERS_FILE = os.environ.get('DEAD_LETTERS_FILE', 'dead_letters.jsonl')
 
 # Initialize data files
 def init_data_files():
-    for file in [USERS_FILE, CHANNELS_FILE, ADMINS_FILE, BROADCASTS_FILE]:
+    for file in [USERS_FILE, CHANNELS_FILE, ADMINS_FILE, BROADCASTS_FILE, BROADCAST_JOBS_FILE]:
         if not os.path.exists(file):
             with open(file, 'w') as f:
                 json.dump([], f)
@@ -39,138 +161,1442 @@ init_data_files()
 # Bot configuration
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 
-if not BOT_TOKEN:
-    raise ValueError("No BOT_TOKEN environment variable set")
-    
 ADMIN_IDS = [1524473035]  # Replace with your admin user ID(s)
 
+# Admins are read from ADMINS_FILE (ADMIN_IDS while it is empty); the file is
+# checked for changes at most every N seconds
+ADMINS_RELOAD_INTERVAL = float(os.environ.get('ADMINS_RELOAD_INTERVAL', '5'))
+
+# Webhook mode: set WEBHOOK_URL to the public HTTPS base URL to receive updates
+# over HTTPS instead of polling. Telegram sends WEBHOOK_SECRET in every request
+# and updates without it are rejected.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_CERT = os.environ.get('WEBHOOK_CERT')
+WEBHOOK_KEY = os.environ.get('WEBHOOK_KEY')
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET must be set when WEBHOOK_URL is used")
+
+# Worker processes share one database, which only the sqlite backend supports
+if WORKER_PROCESSES and STORAGE_BACKEND != 'sqlite':
+    raise ValueError("WORKER_PROCESSES requires STORAGE_BACKEND=sqlite")
+
+# Only the update types the handlers use
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_JOIN_REQUEST]
+
 # Helper functions
 def read_json(file: str) -> List[Dict]:
     with open(file, 'r') as f:
         return json.load(f)
 
 def write_json(file: str, data: List[Dict]):
-    with open(file, 'w') as f:
+    # Write to a temporary file first so a crash never leaves a truncated file
+    tmp_file = f"{file}.tmp"
+    with open(tmp_file, 'w') as f:
         json.dump(data, f, indent=2)
+    os.replace(tmp_file, file)
 
-def save_user(user_id: int, username: str, first_name: str, last_name: str, channel_id: int, channel_title: str):
-    users = read_json(USERS_FILE)
-    
-    # Check if user exists
-    user_exists = False
-    for user in users:
-        if user['user_id'] == user_id:
-            user_exists = True
+class JsonStorage:
+    # Users and channels are loaded once into memory and indexed by id.
+    # Changes are flushed back to the JSON files in batches by a background
+    # thread, either every FLUSH_INTERVAL seconds or once FLUSH_THRESHOLD
+    # changes are pending, instead of on every approval.
+    flush_interval = FLUSH_INTERVAL
+    flush_threshold = FLUSH_THRESHOLD
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.users_dirty = False
+        self.channels_dirty = False
+        self.export_user_ids: Optional[List[int]] = None
+        # Created before load(), since replaying a journal marks changes dirty
+        self.flush_lock = threading.Lock()
+        self.flush_wakeup = threading.Event()
+        self.load()
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_loop, name='storage-flusher', daemon=True)
+        self.flusher.start()
+
+    def load(self):
+        self.users: Dict[int, Dict] = {user['user_id']: user for user in read_json(USERS_FILE)}
+        self.channels: Dict[int, Dict] = {channel['channel_id']: channel for channel in read_json(CHANNELS_FILE)}
+        self.broadcasts: List[Dict] = read_json(BROADCASTS_FILE)
+        self.broadcast_jobs: Dict[str, Dict] = {job['job_id']: job for job in read_json(BROADCAST_JOBS_FILE)}
+        # Inverted index from channel_id to the users approved in it
+        self.channel_members: Dict[int, Set[int]] = {}
+        for user in self.users.values():
+            for channel_id in user['approved_channels']:
+                self.channel_members.setdefault(channel_id, set()).add(user['user_id'])
+        # Running aggregates for /stats, kept up to date by every write
+        self.unreachable_count = sum(1 for user in self.users.values() if user.get('status'))
+        self.broadcast_totals = {key: 0 for key in BROADCAST_TOTAL_KEYS}
+        for broadcast in self.broadcasts:
+            self._add_broadcast_totals(broadcast)
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.flush_wakeup.wait(self.flush_interval)
+            self.flush_wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing storage: {e}")
+
+    def _mark_dirty(self):
+        self.pending += 1
+        if self.pending >= self.flush_threshold:
+            self.flush_wakeup.set()
+
+    def flush(self):
+        with self.flush_lock:
+            # Copy the dirty data under the lock, write it outside of it
+            with self.lock:
+                if not self.pending:
+                    return
+                users = None
+                channels = None
+                if self.users_dirty:
+                    users = [dict(user, approved_channels=list(user['approved_channels'])) for user in self.users.values()]
+                if self.channels_dirty:
+                    channels = [dict(channel) for channel in self.channels.values()]
+                self.pending = 0
+                self.users_dirty = False
+                self.channels_dirty = False
+            if users is not None:
+                write_json(USERS_FILE, users)
+            if channels is not None:
+                write_json(CHANNELS_FILE, channels)
+
+    def close(self):
+        self.closed = True
+        self.flush_wakeup.set()
+        self.flusher.join()
+        self.flush()
+
+    def _apply_user(self, user_id: int, username: str, first_name: str, last_name: str, channel_id: int, channel_title: str, now: str) -> bool:
+        # Apply an approval to the in-memory index; returns whether anything changed
+        changed = False
+        user = self.users.get(user_id)
+        if user is None:
+            # New user
+            self.users[user_id] = {
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'join_date': now,
+                'approved_channels': [channel_id]
+            }
+            changed = True
+        elif channel_id not in user['approved_channels']:
             # Add channel if not already there
-            if channel_id not in user['approved_channels']:
-                user['approved_channels'].append(channel_id)
-            break
-    
-    if not user_exists:
-        # New user
-        users.append({
+            user['approved_channels'].append(channel_id)
+            changed = True
+        if changed:
+            self.channel_members.setdefault(channel_id, set()).add(user_id)
+            self.users_dirty = True
+            self._mark_dirty()
+        
+        # Save channel info if not exists
+        if channel_id not in self.channels:
+            self.channels[channel_id] = {
+                'channel_id': channel_id,
+                'title': channel_title,
+                'username': f"channel_{channel_id}",
+                'join_date': now
+            }
+            self.channels_dirty = True
+            self._mark_dirty()
+            changed = True
+        return changed
+
+    def save_user(self, user_id: int, username: str, first_name: str, last_name: str, channel_id: int, channel_title: str):
+        with self.lock:
+            self._apply_user(user_id, username, first_name, last_name, channel_id, channel_title, str(datetime.datetime.now()))
+
+    def _apply_import(self, rows: List[Tuple], now: str) -> Tuple[int, List[Tuple]]:
+        # Merge imported (user_id, username, first_name, last_name, channel_id,
+        # channel_title) rows; returns the number of new memberships and the
+        # rows that changed anything
+        added = 0
+        changed = []
+        for row in rows:
+            user = self.users.get(row[0])
+            if user is None or row[4] not in user['approved_channels']:
+                added += 1
+            if self._apply_user(*row, now):
+                changed.append(row)
+        return added, changed
+
+    def import_users(self, rows: List[Tuple]) -> int:
+        with self.lock:
+            return self._apply_import(rows, str(datetime.datetime.now()))[0]
+
+    def get_broadcast_recipients(self, after: int, reprobe_before: str,
+                                 channel_ids: Optional[List[int]] = None, match: str = 'union') -> List[int]:
+        # Reachable users, plus unreachable ones whose last failure is old enough
+        # to re-probe; optionally only members of the given channels
+        with self.lock:
+            if channel_ids:
+                members = sorted((self.channel_members.get(channel_id, set()) for channel_id in channel_ids), key=len)
+                if match == 'intersection':
+                    candidates = members[0].intersection(*members[1:])
+                else:
+                    candidates = set().union(*members)
+            else:
+                candidates = self.users
+            users = self.users
+            return sorted(
+                user_id for user_id in candidates
+                if user_id > after and (not users[user_id].get('status') or users[user_id]['last_failure'] < reprobe_before)
+            )
+
+    def get_unreachable_ids(self) -> List[int]:
+        with self.lock:
+            return [user_id for user_id, user in self.users.items() if user.get('status')]
+
+    def get_user_page(self, after: Optional[int], limit: int) -> List[Dict]:
+        # The next `limit` users by user ID, for exports. The first page of an
+        # export takes a sorted snapshot of the user IDs that later pages
+        # bisect into, so a page costs O(limit) instead of a pass over every
+        # user. Users never go away, so a snapshot taken by a later export
+        # still serves one that is running.
+        with self.lock:
+            if after is None or self.export_user_ids is None:
+                self.export_user_ids = sorted(self.users)
+            user_ids = self.export_user_ids
+            start = bisect.bisect_right(user_ids, after) if after is not None else 0
+            page = user_ids[start:start + limit]
+            if not page:
+                # The export is done; don't hold on to the snapshot
+                self.export_user_ids = None
+            return [dict(self.users[user_id], approved_channels=list(self.users[user_id]['approved_channels']))
+                    for user_id in page]
+
+    def get_channel_page(self, after: Optional[int], limit: int) -> List[Dict]:
+        with self.lock:
+            channel_ids = heapq.nsmallest(limit, (channel_id for channel_id in self.channels if after is None or channel_id > after))
+            return [dict(self.channels[channel_id], user_count=len(self.channel_members.get(channel_id, ())))
+                    for channel_id in channel_ids]
+
+    def _apply_reachability(self, updates: List[Tuple[int, Optional[str]]], now: str):
+        for user_id, status in updates:
+            user = self.users.get(user_id)
+            if user is None:
+                continue
+            if bool(status) != bool(user.get('status')):
+                self.unreachable_count += 1 if status else -1
+            if status:
+                user['status'] = status
+                user['last_failure'] = now
+            else:
+                user.pop('status', None)
+                user.pop('last_failure', None)
+        self.users_dirty = True
+        self._mark_dirty()
+
+    def set_reachability(self, updates: List[Tuple[int, Optional[str]]]):
+        with self.lock:
+            self._apply_reachability(updates, str(datetime.datetime.now()))
+
+    def _add_broadcast_totals(self, record: Dict):
+        self.broadcast_totals['total_broadcasts'] += 1
+        self.broadcast_totals['total_recipients'] += record['total_users']
+        for key in ('successful', 'blocked', 'deleted', 'unsuccessful'):
+            self.broadcast_totals[f"total_{key}"] += record[key]
+
+    def save_broadcast(self, record: Dict):
+        # Broadcasts are rare, so they are written straight through
+        with self.lock:
+            self.broadcasts.append(record)
+            self._add_broadcast_totals(record)
+            broadcasts = list(self.broadcasts)
+        write_json(BROADCASTS_FILE, broadcasts)
+
+    def save_broadcast_job(self, job: Dict):
+        with self.lock:
+            self.broadcast_jobs[job['job_id']] = job
+            jobs = list(self.broadcast_jobs.values())
+        write_json(BROADCAST_JOBS_FILE, jobs)
+
+    def delete_broadcast_job(self, job_id: str):
+        with self.lock:
+            self.broadcast_jobs.pop(job_id, None)
+            jobs = list(self.broadcast_jobs.values())
+        write_json(BROADCAST_JOBS_FILE, jobs)
+
+    def get_broadcast_jobs(self) -> List[Dict]:
+        with self.lock:
+            return list(self.broadcast_jobs.values())
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            top_channels = heapq.nlargest(STATS_TOP_CHANNELS, self.channels,
+                                          key=lambda channel_id: len(self.channel_members.get(channel_id, ())))
+            return dict(
+                self.broadcast_totals,
+                total_users=len(self.users),
+                total_channels=len(self.channels),
+                unreachable_users=self.unreachable_count,
+                channels=[
+                    (self.channels[channel_id]['title'], len(self.channel_members.get(channel_id, ())))
+                    for channel_id in top_channels
+                ]
+            )
+
+class JournalStorage(JsonStorage):
+    # Same in-memory index as JsonStorage, but every change is appended as one
+    # compact line to JOURNAL_FILE. The background thread periodically folds
+    # the journal into the JSON snapshot files (the regular users.json and
+    # channels.json format) and starts a new journal. Startup loads the
+    # snapshot and replays the journal on top of it.
+    flush_interval = COMPACT_INTERVAL
+    flush_threshold = COMPACT_THRESHOLD
+
+    def load(self):
+        super().load()
+        # A journal left over from an interrupted compaction comes first
+        replayed = self._replay(f"{JOURNAL_FILE}.compacting") + self._replay(JOURNAL_FILE)
+        if replayed:
+            logger.info(f"Replayed {replayed} journal entries")
+        self.journal = open(JOURNAL_FILE, 'a')
+
+    def _replay(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of the journal
+                    logger.warning(f"Skipping malformed journal line in {path}")
+                    continue
+                if entry.get('op') == 'user':
+                    self._apply_user(entry['user_id'], entry['username'], entry['first_name'], entry['last_name'],
+                                     entry['channel_id'], entry['channel_title'], entry['date'])
+                    count += 1
+                elif entry.get('op') == 'reachability':
+                    self._apply_reachability(entry['updates'], entry['date'])
+                    count += 1
+                elif entry.get('op') == 'import':
+                    self._apply_import(entry['rows'], entry['date'])
+                    count += 1
+        return count
+
+    def _append(self, entry: Dict):
+        self.journal.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.journal.flush()
+
+    def save_user(self, user_id: int, username: str, first_name: str, last_name: str, channel_id: int, channel_title: str):
+        now = str(datetime.datetime.now())
+        with self.lock:
+            if not self._apply_user(user_id, username, first_name, last_name, channel_id, channel_title, now):
+                return
+            self._append({
+                'op': 'user',
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'channel_id': channel_id,
+                'channel_title': channel_title,
+                'date': now
+            })
+
+    def set_reachability(self, updates: List[Tuple[int, Optional[str]]]):
+        now = str(datetime.datetime.now())
+        with self.lock:
+            self._apply_reachability(updates, now)
+            self._append({'op': 'reachability', 'updates': updates, 'date': now})
+
+    def import_users(self, rows: List[Tuple]) -> int:
+        # One journal line per batch
+        now = str(datetime.datetime.now())
+        with self.lock:
+            added, changed = self._apply_import(rows, now)
+            if changed:
+                self._append({'op': 'import', 'rows': changed, 'date': now})
+        return added
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                # Set the current journal aside; new changes go to a fresh one
+                self.journal.close()
+                compacting = f"{JOURNAL_FILE}.compacting"
+                if os.path.exists(compacting):
+                    # Left over from a crash during compaction and not in the
+                    # snapshot yet, so add the journal to it instead of replacing it
+                    with open(compacting, 'rb+') as dst, open(JOURNAL_FILE, 'rb') as src:
+                        dst.seek(0, os.SEEK_END)
+                        if dst.tell():
+                            dst.seek(-1, os.SEEK_END)
+                            if dst.read(1) != b'\n':
+                                dst.write(b'\n')
+                        shutil.copyfileobj(src, dst)
+                    os.remove(JOURNAL_FILE)
+                else:
+                    os.replace(JOURNAL_FILE, compacting)
+                self.journal = open(JOURNAL_FILE, 'a')
+                users = [dict(user, approved_channels=list(user['approved_channels'])) for user in self.users.values()]
+                channels = [dict(channel) for channel in self.channels.values()]
+                self.pending = 0
+                self.users_dirty = False
+                self.channels_dirty = False
+            write_json(USERS_FILE, users)
+            write_json(CHANNELS_FILE, channels)
+            # Only now is everything in the journal safely in the snapshot
+            os.remove(f"{JOURNAL_FILE}.compacting")
+
+    def close(self):
+        super().close()
+        self.journal.close()
+
+class SqliteStorage:
+    # SQLite storage in WAL mode; approvals are single-row upserts
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            join_date TEXT,
+            status TEXT,
+            last_failure TEXT
+        );
+        CREATE TABLE IF NOT EXISTS user_channels (
+            user_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, channel_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_user_channels_channel ON user_channels (channel_id);
+        CREATE TABLE IF NOT EXISTS channels (
+            channel_id INTEGER PRIMARY KEY,
+            title TEXT,
+            username TEXT,
+            join_date TEXT,
+            user_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            message_type TEXT,
+            sent_date TEXT,
+            total_users INTEGER,
+            successful INTEGER,
+            blocked INTEGER,
+            deleted INTEGER,
+            unsuccessful INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_broadcasts_sent_date ON broadcasts (sent_date);
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self._upgrade_schema()
+        if is_new:
+            self._migrate_json()
+        self._init_counters()
+
+    def _upgrade_schema(self):
+        # Add columns introduced after the database was created
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if 'status' not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN status TEXT")
+            self.conn.execute("ALTER TABLE users ADD COLUMN last_failure TEXT")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users (last_failure) WHERE status IS NOT NULL"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(channels)")}
+        if 'user_count' not in columns:
+            self.conn.execute("ALTER TABLE channels ADD COLUMN user_count INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_channels_user_count ON channels (user_count)")
+
+    def _init_counters(self):
+        # One full count when the counters are first created; afterwards
+        # every write keeps them up to date in the same transaction
+        if self.conn.execute("SELECT COUNT(*) FROM counters").fetchone()[0]:
+            return
+        row = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(total_users), 0), COALESCE(SUM(successful), 0), COALESCE(SUM(blocked), 0), "
+            "COALESCE(SUM(deleted), 0), COALESCE(SUM(unsuccessful), 0) FROM broadcasts"
+        ).fetchone()
+        counters = dict(zip(BROADCAST_TOTAL_KEYS, row))
+        counters['total_users'] = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        counters['total_channels'] = self.conn.execute("SELECT COUNT(*) FROM channels").fetchone()[0]
+        counters['unreachable_users'] = self.conn.execute("SELECT COUNT(*) FROM users WHERE status IS NOT NULL").fetchone()[0]
+        with self.conn:
+            self.conn.execute(
+                "UPDATE channels SET user_count = (SELECT COUNT(*) FROM user_channels WHERE channel_id = channels.channel_id)"
+            )
+            self.conn.executemany("INSERT INTO counters (name, value) VALUES (?, ?)", counters.items())
+
+    def _bump(self, **deltas: int):
+        self.conn.executemany(
+            "UPDATE counters SET value = value + ? WHERE name = ?",
+            [(delta, name) for name, delta in deltas.items() if delta]
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def _migrate_json(self):
+        # Import existing JSON data the first time the database is created
+        with self.conn:
+            for user in read_json(USERS_FILE):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date) VALUES (?, ?, ?, ?, ?)",
+                    (user['user_id'], user.get('username'), user.get('first_name'), user.get('last_name'), user.get('join_date'))
+                )
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO user_channels (user_id, channel_id) VALUES (?, ?)",
+                    [(user['user_id'], channel_id) for channel_id in user.get('approved_channels', [])]
+                )
+            for channel in read_json(CHANNELS_FILE):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO channels (channel_id, title, username, join_date) VALUES (?, ?, ?, ?)",
+                    (channel['channel_id'], channel.get('title'), channel.get('username'), channel.get('join_date'))
+                )
+            for broadcast in read_json(BROADCASTS_FILE):
+                self._insert_broadcast(broadcast)
+        logger.info("Migrated JSON data files into SQLite storage")
+
+    def save_user(self, user_id: int, username: str, first_name: str, last_name: str, channel_id: int, channel_title: str):
+        now = str(datetime.datetime.now())
+        with self.conn:
+            new_user = self.conn.execute(
+                "INSERT INTO users (user_id, username, first_name, last_name, join_date) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO NOTHING",
+                (user_id, username, first_name, last_name, now)
+            ).rowcount
+            new_channel = self.conn.execute(
+                "INSERT OR IGNORE INTO channels (channel_id, title, username, join_date) VALUES (?, ?, ?, ?)",
+                (channel_id, channel_title, f"channel_{channel_id}", now)
+            ).rowcount
+            new_member = self.conn.execute(
+                "INSERT OR IGNORE INTO user_channels (user_id, channel_id) VALUES (?, ?)",
+                (user_id, channel_id)
+            ).rowcount
+            if new_member:
+                self.conn.execute("UPDATE channels SET user_count = user_count + 1 WHERE channel_id = ?", (channel_id,))
+            self._bump(total_users=new_user, total_channels=new_channel)
+
+    def import_users(self, rows: List[Tuple]) -> int:
+        # Merge a batch of imported (user_id, username, first_name, last_name,
+        # channel_id, channel_title) rows in one transaction; returns the
+        # number of new memberships
+        now = str(datetime.datetime.now())
+        users = {}
+        channels = {}
+        pairs = set()
+        for user_id, username, first_name, last_name, channel_id, channel_title in rows:
+            users.setdefault(user_id, (user_id, username, first_name, last_name, now))
+            channels.setdefault(channel_id, (channel_id, channel_title, f"channel_{channel_id}", now))
+            pairs.add((user_id, channel_id))
+        added: Dict[int, int] = {}
+        with self.conn:
+            new_users = self.conn.executemany(
+                "INSERT INTO users (user_id, username, first_name, last_name, join_date) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO NOTHING",
+                list(users.values())
+            ).rowcount
+            new_channels = self.conn.executemany(
+                "INSERT OR IGNORE INTO channels (channel_id, title, username, join_date) VALUES (?, ?, ?, ?)",
+                list(channels.values())
+            ).rowcount
+            for user_id, channel_id in pairs:
+                if self.conn.execute(
+                    "INSERT OR IGNORE INTO user_channels (user_id, channel_id) VALUES (?, ?)", (user_id, channel_id)
+                ).rowcount:
+                    added[channel_id] = added.get(channel_id, 0) + 1
+            self.conn.executemany(
+                "UPDATE channels SET user_count = user_count + ? WHERE channel_id = ?",
+                [(count, channel_id) for channel_id, count in added.items()]
+            )
+            self._bump(total_users=new_users, total_channels=new_channels)
+        return sum(added.values())
+
+    def get_broadcast_recipients(self, after: int, reprobe_before: str,
+                                 channel_ids: Optional[List[int]] = None, match: str = 'union') -> List[int]:
+        # Reachable users, plus unreachable ones whose last failure is old enough
+        # to re-probe; optionally only members of the given channels
+        if not channel_ids:
+            return [row[0] for row in self.conn.execute(
+                "SELECT user_id FROM users WHERE user_id > ? AND (status IS NULL OR last_failure < ?) ORDER BY user_id",
+                (after, reprobe_before)
+            )]
+        placeholders = ', '.join('?' * len(channel_ids))
+        having = f"HAVING COUNT(*) = {len(set(channel_ids))} " if match == 'intersection' else ""
+        return [row[0] for row in self.conn.execute(
+            "SELECT u.user_id FROM user_channels uc JOIN users u ON u.user_id = uc.user_id "
+            f"WHERE uc.channel_id IN ({placeholders}) AND u.user_id > ? AND (u.status IS NULL OR u.last_failure < ?) "
+            f"GROUP BY u.user_id {having}ORDER BY u.user_id",
+            (*channel_ids, after, reprobe_before)
+        )]
+
+    def get_unreachable_ids(self) -> List[int]:
+        return [row[0] for row in self.conn.execute("SELECT user_id FROM users WHERE status IS NOT NULL")]
+
+    def get_user_page(self, after: Optional[int], limit: int) -> List[Dict]:
+        # The next `limit` users by user ID, for exports
+        rows = self.conn.execute(
+            "SELECT u.user_id, u.username, u.first_name, u.last_name, u.join_date, u.status, u.last_failure, "
+            "group_concat(uc.channel_id) FROM users u LEFT JOIN user_channels uc ON uc.user_id = u.user_id "
+            "WHERE u.user_id > ? GROUP BY u.user_id ORDER BY u.user_id LIMIT ?",
+            (after if after is not None else -2 ** 63, limit)
+        )
+        return [{
             'user_id': user_id,
             'username': username,
             'first_name': first_name,
             'last_name': last_name,
-            'join_date': str(datetime.datetime.now()),
-            'approved_channels': [channel_id]
-        })
-    
-    write_json(USERS_FILE, users)
-    
-    # Save channel info if not exists
-    channels = read_json(CHANNELS_FILE)
-    channel_exists = any(channel['channel_id'] == channel_id for channel in channels)
-    if not channel_exists:
-        channels.append({
+            'join_date': join_date,
+            'status': status,
+            'last_failure': last_failure,
+            'approved_channels': [int(channel_id) for channel_id in channels.split(',')] if channels else []
+        } for user_id, username, first_name, last_name, join_date, status, last_failure, channels in rows]
+
+    def get_channel_page(self, after: Optional[int], limit: int) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT channel_id, title, username, join_date, user_count FROM channels "
+            "WHERE channel_id > ? ORDER BY channel_id LIMIT ?",
+            (after if after is not None else -2 ** 63, limit)
+        )
+        return [{
             'channel_id': channel_id,
-            'title': channel_title,
-            'username': f"channel_{channel_id}",
-            'join_date': str(datetime.datetime.now())
-        })
-        write_json(CHANNELS_FILE, channels)
+            'title': title,
+            'username': username,
+            'join_date': join_date,
+            'user_count': user_count
+        } for channel_id, title, username, join_date, user_count in rows]
 
-async def approve_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.chat_join_request.from_user.id
-    username = update.chat_join_request.from_user.username or "No username"
-    first_name = update.chat_join_request.from_user.first_name or ""
-    last_name = update.chat_join_request.from_user.last_name or ""
-    channel_id = update.chat_join_request.chat.id
-    channel_title = update.chat_join_request.chat.title or f"Channel {channel_id}"
+    def set_reachability(self, updates: List[Tuple[int, Optional[str]]]):
+        now = str(datetime.datetime.now())
+        unreachable = [(status, now, user_id) for user_id, status in updates if status]
+        reachable = [(user_id,) for user_id, status in updates if not status]
+        with self.conn:
+            # Users that just became unreachable count towards the total, the rest refresh
+            became_unreachable = self.conn.executemany(
+                "UPDATE users SET status = ?, last_failure = ? WHERE user_id = ? AND status IS NULL", unreachable
+            ).rowcount
+            self.conn.executemany(
+                "UPDATE users SET status = ?, last_failure = ? WHERE user_id = ? AND status IS NOT NULL", unreachable
+            )
+            became_reachable = self.conn.executemany(
+                "UPDATE users SET status = NULL, last_failure = NULL WHERE user_id = ? AND status IS NOT NULL", reachable
+            ).rowcount
+            self._bump(unreachable_users=became_unreachable - became_reachable)
+
+    def _insert_broadcast(self, record: Dict):
+        self.conn.execute(
+            "INSERT INTO broadcasts (admin_id, message_type, sent_date, total_users, successful, blocked, deleted, unsuccessful) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (record['admin_id'], record['message_type'], record['sent_date'], record['total_users'],
+             record['successful'], record['blocked'], record['deleted'], record['unsuccessful'])
+        )
+
+    def save_broadcast(self, record: Dict):
+        with self.conn:
+            self._insert_broadcast(record)
+            self._bump(
+                total_broadcasts=1,
+                total_recipients=record['total_users'],
+                total_successful=record['successful'],
+                total_blocked=record['blocked'],
+                total_deleted=record['deleted'],
+                total_unsuccessful=record['unsuccessful']
+            )
+
+    def save_broadcast_job(self, job: Dict):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO broadcast_jobs (job_id, data) VALUES (?, ?)",
+                (job['job_id'], json.dumps(job))
+            )
+
+    def delete_broadcast_job(self, job_id: str):
+        with self.conn:
+            self.conn.execute("DELETE FROM broadcast_jobs WHERE job_id = ?", (job_id,))
+
+    def get_broadcast_jobs(self) -> List[Dict]:
+        return [json.loads(row[0]) for row in self.conn.execute("SELECT data FROM broadcast_jobs")]
+
+    def get_stats(self) -> Dict:
+        data = dict(self.conn.execute("SELECT name, value FROM counters"))
+        data['channels'] = self.conn.execute(
+            "SELECT title, user_count FROM channels ORDER BY user_count DESC LIMIT ?", (STATS_TOP_CHANNELS,)
+        ).fetchall()
+        return data
+
+# Cumulative broadcast totals kept by the storage backends for /stats
+BROADCAST_TOTAL_KEYS = [
+    'total_broadcasts', 'total_recipients', 'total_successful',
+    'total_blocked', 'total_deleted', 'total_unsuccessful'
+]
+
+def create_storage():
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_FILE)
+    if STORAGE_BACKEND == 'json':
+        return JsonStorage()
+    if STORAGE_BACKEND == 'journal':
+        return JournalStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+storage = create_storage()
+
+# Prometheus metrics. Everything is updated from the event loop thread and
+# rendered in the text exposition format by the /metrics endpoint.
+metrics_registry = []
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)) + '}'
+
+class Metric:
+    # A counter or gauge, with one value per combination of label values
+    def __init__(self, name: str, help_text: str, kind: str = 'counter', labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+        metrics_registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram(Metric):
+    # Cumulative bucket counts plus sum and count per combination of label values
+    def __init__(self, name: str, help_text: str, buckets: List[float], labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, 'histogram', labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ('le',)
+        for label_values, entry in self.values.items():
+            for bound, count in zip(self.buckets, entry):
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + ('+Inf',))} {entry[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {entry[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {entry[-1]}")
+        return lines
+
+join_requests_received = Metric(
+    'bot_join_requests_received_total', 'Join requests received', labels=('channel_id',))
+join_requests_approved = Metric(
+    'bot_join_requests_approved_total', 'Join requests approved', labels=('channel_id',))
+join_requests_failed = Metric(
+    'bot_join_requests_failed_total', 'Join requests that could not be approved', labels=('channel_id', 'reason'))
+approval_latency = Histogram(
+    'bot_approval_latency_seconds', 'Time from the join request to its approval',
+    [0.5, 1, 2.5, 5, 10, 30, 60, 300, 900])
+welcome_messages = Metric(
+    'bot_welcome_messages_total', 'Welcome DMs by result', labels=('result',))
+broadcast_messages = Metric(
+    'bot_broadcast_messages_total', 'Broadcast deliveries by result', labels=('result',))
+storage_latency = Histogram(
+    'bot_storage_operation_seconds', 'Storage operation time, including the wait for the storage thread',
+    [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5], labels=('operation',))
+event_loop_lag = Histogram(
+    'bot_event_loop_lag_seconds', 'Event loop wake-up delay',
+    [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5])
+approval_queue_depth = Metric('bot_approval_queue_depth', 'Join requests waiting for approval', 'gauge')
+welcome_queue_depth = Metric('bot_welcome_queue_depth', 'Welcome DMs waiting to be sent', 'gauge')
+running_broadcasts = Metric('bot_running_broadcasts', 'Broadcasts in progress', 'gauge')
+http_requests = Metric('bot_http_requests_total', 'Bot API requests by connection pool', labels=('pool',))
+http_pool_wait = Metric(
+    'bot_http_pool_wait_seconds_total', 'Time spent waiting for a free connection', labels=('pool',))
+http_pool_in_use = Metric('bot_http_pool_in_use', 'Connections in use', 'gauge', labels=('pool',))
+
+# All storage operations run on one dedicated thread so disk I/O never blocks
+# the event loop; a single worker also serializes writes to the backend
+storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+
+async def run_storage(func, *args):
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        return await loop.run_in_executor(storage_executor, functools.partial(func, *args))
+    finally:
+        storage_latency.observe(time.monotonic() - started, func.__name__)
+
+class UpdateQueue:
+    # SQLite table of raw updates shared by the ingress and worker processes.
+    # Each worker reads its own partition in arrival order and deletes rows
+    # only once they are handled (join requests are approved inline in worker
+    # mode), so a crashed worker's updates are redone.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS updates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            partition INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_updates_partition ON updates (partition, id);
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+
+    def put(self, partition: int, data: str):
+        with self.conn:
+            self.conn.execute("INSERT INTO updates (partition, data) VALUES (?, ?)", (partition, data))
+
+    def take(self, partition: int, limit: int) -> List[Tuple[int, Dict]]:
+        return [(row_id, json.loads(data)) for row_id, data in self.conn.execute(
+            "SELECT id, data FROM updates WHERE partition = ? ORDER BY id LIMIT ?", (partition, limit)
+        )]
+
+    def ack(self, row_ids: List[int]):
+        with self.conn:
+            self.conn.executemany("DELETE FROM updates WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+    def depth(self, partition: int) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM updates WHERE partition = ?", (partition,)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+update_queue = UpdateQueue(UPDATE_QUEUE_FILE) if WORKER_PROCESSES else None
+
+# Partition handled by this process when it is a worker
+worker_index: Optional[int] = None
+
+def save_user(user_id: int, username: str, first_name: str, last_name: str, channel_id: int, channel_title: str):
+    storage.save_user(user_id, username, first_name, last_name, channel_id, channel_title)
+
+class AdminCache:
+    # Admin user IDs from ADMINS_FILE, held as a frozenset for the permission
+    # checks. A background task checks the file on the storage thread every
+    # reload_interval seconds and re-reads it when its mtime, size or inode
+    # changes, so edits by hand or from another process apply without a restart.
+    def __init__(self, path: str, reload_interval: float):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.ids: frozenset = frozenset(ADMIN_IDS)
+        self.signature = None
+        self.reload()
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if signature == self.signature:
+            return
+        try:
+            ids = frozenset(int(user_id) for user_id in read_json(self.path))
+        except (ValueError, TypeError) as e:
+            logger.error(f"Could not load {self.path}, keeping the current admins: {e}")
+            return
+        self.signature = signature
+        self.ids = ids or frozenset(ADMIN_IDS)
+        logger.info(f"Loaded {len(self.ids)} admins from {self.path}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await run_storage(self.reload)
+            except Exception as e:
+                logger.error(f"Could not check {self.path}: {e}")
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.ids
+
+    def _save(self, ids: frozenset):
+        write_json(self.path, sorted(ids))
+        self.reload()
+
+    def add(self, user_id: int) -> bool:
+        self.reload()
+        if user_id in self.ids:
+            return False
+        self._save(self.ids | {user_id})
+        return True
+
+    def remove(self, user_id: int) -> bool:
+        self.reload()
+        if user_id not in self.ids:
+            return False
+        self._save(self.ids - {user_id})
+        return True
+
+admins = AdminCache(ADMINS_FILE, ADMINS_RELOAD_INTERVAL)
+
+def is_admin(user_id: int) -> bool:
+    return user_id in admins
+
+class LoopLagMonitor:
+    # Measures how late the event loop wakes up from a short sleep
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(loop.time() - start - self.interval, 0.0)
+            self.max = max(self.max, self.last)
+            event_loop_lag.observe(self.last)
+            if self.last > LOOP_LAG_WARNING:
+                logger.warning(f"Event loop lag of {self.last * 1000:.0f} ms")
+
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
+# Long-running tasks (workers, broadcasts) that are cancelled on shutdown
+background_tasks = set()
+
+def start_background_task(coroutine, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coroutine, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def stop_background_tasks():
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# Rate limiting for outgoing Bot API calls. Lower numbers are served first:
+# approvals and admin UI edits, then welcome DMs, then broadcast deliveries.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Calls that don't count against Telegram's sending limits
+UNLIMITED_ENDPOINTS = {'getUpdates', 'getMe', 'answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'getFile'}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    # Shared by every request the bot makes. All calls draw from a global
+    # messages-per-second budget; sends and edits additionally draw from a
+    # per-chat budget that is stricter for groups and channels. A call waits
+    # while any higher-priority call is waiting for the global budget.
+    def __init__(self, global_rate: float, chat_rate: float, group_rate_per_minute: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_minute / 60
+        self.chat_buckets: Dict[object, TokenBucket] = {}
+        self.waiting = [0, 0, 0]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # A full bucket is the same as no bucket, so drop those
+                now = time.monotonic()
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full(now)}
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    async def acquire(self, priority: int, chat_id=None):
+        waiting = False
+        try:
+            while True:
+                now = time.monotonic()
+                # A call held back by its own chat doesn't block other chats
+                chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                if chat_bucket is not None:
+                    wait = chat_bucket.wait_time(now)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                        continue
+                if any(self.waiting[:priority]):
+                    await asyncio.sleep(0.01)
+                    continue
+                wait = self.global_bucket.wait_time(now)
+                if wait <= 0:
+                    self.global_bucket.consume()
+                    if chat_bucket is not None:
+                        chat_bucket.consume()
+                    return
+                if not waiting:
+                    self.waiting[priority] += 1
+                    waiting = True
+                await asyncio.sleep(wait)
+        finally:
+            if waiting:
+                self.waiting[priority] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint not in UNLIMITED_ENDPOINTS:
+            priority = (rate_limit_args or {}).get('priority', PRIORITY_HIGH)
+            per_chat = endpoint.startswith(('send', 'copy', 'forward', 'edit'))
+            await self.acquire(priority, data.get('chat_id') if per_chat else None)
+        return await callback(*args, **kwargs)
+
+rate_limiter = TokenBucketRateLimiter(GLOBAL_RATE_LIMIT, CHAT_RATE_LIMIT, GROUP_RATE_LIMIT)
+
+class PooledRequest(HTTPXRequest):
+    # HTTPXRequest that takes one of pool_size slots for each request in
+    # flight. Requests never queue inside httpx, so the time spent waiting
+    # for a slot is the pool wait and is recorded for /stats. A request that
+    # gets no slot within POOL_TIMEOUT fails with TimedOut.
+    def __init__(self, name: str, pool_size: int, **kwargs):
+        super().__init__(connection_pool_size=pool_size, pool_timeout=POOL_TIMEOUT, **kwargs)
+        self.name = name
+        self.pool_size = pool_size
+        self.slots = asyncio.Semaphore(pool_size)
+        self.in_use = 0
+        self.requests = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def do_request(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), POOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Same error httpx's own pool timeout becomes, so call_with_retry retries it
+            raise TimedOut(f"Pool timeout: all {self.pool_size} connections of the {self.name} pool are in use")
+        wait = time.monotonic() - started
+        self.requests += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.in_use += 1
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            self.in_use -= 1
+            self.slots.release()
+
+updates_request = PooledRequest('updates', UPDATES_POOL_SIZE)
+api_request = PooledRequest('api', API_POOL_SIZE)
+bulk_request = PooledRequest('bulk', BULK_POOL_SIZE)
+request_pools = [updates_request, api_request, bulk_request]
+
+# Bot for broadcasts and welcome DMs, on the bulk pool. It shares the
+# application bot's rate limiter and is set up in on_startup.
+bulk_bot: Optional[ExtBot] = None
+
+# Retries and dead letters. Flood waits honor the server's retry_after,
+# timeouts and network/5xx errors back off exponentially with jitter, and
+# anything else fails immediately. Operations that run out of attempts are
+# appended to DEAD_LETTERS_FILE and can be replayed with /replay.
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+def add_dead_letter(entry: Dict):
+    with open(DEAD_LETTERS_FILE, 'a') as f:
+        f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+def take_dead_letters() -> List[Dict]:
+    # Move the file aside first so new dead letters aren't lost while replaying
+    if not os.path.exists(DEAD_LETTERS_FILE):
+        return []
+    taken_file = f"{DEAD_LETTERS_FILE}.replaying"
+    os.replace(DEAD_LETTERS_FILE, taken_file)
+    with open(taken_file, 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    os.remove(taken_file)
+    return entries
+
+class ErrorClass(NamedTuple):
+    counter: str            # 'blocked', 'deleted' or 'unsuccessful', as in the broadcast stats
+    retryable: bool         # worth trying again (flood wait, timeout, network or 5xx error)
+    status: Optional[str]   # reachability status to record when the user can't be reached
+
+def classify_error(error: Exception) -> ErrorClass:
+    # Classify a failed Bot API call by its telegram.error type. Forbidden and
+    # BadRequest carry no finer type, so their description tells which kind
+    # of unreachable user it is.
+    if isinstance(error, Forbidden):
+        if 'blocked' in error.message:
+            return ErrorClass('blocked', False, 'blocked')
+        if 'deactivated' in error.message:
+            return ErrorClass('deleted', False, 'deactivated')
+        return ErrorClass('unsuccessful', False, None)
+    if isinstance(error, BadRequest):
+        if 'chat not found' in error.message.lower():
+            return ErrorClass('deleted', False, 'chat_not_found')
+        return ErrorClass('unsuccessful', False, None)
+    if isinstance(error, (RetryAfter, NetworkError)):
+        return ErrorClass('unsuccessful', True, None)
+    return ErrorClass('unsuccessful', False, None)
+
+async def call_with_retry(operation: str, func, *args, dead_letter: Optional[Dict] = None, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            return await func(*args, **kwargs)
+        except TelegramError as e:
+            if not classify_error(e).retryable:
+                raise
+            error = e
+        
+        if isinstance(error, RetryAfter):
+            delay = retry_after_seconds(error)
+        else:
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        
+        attempt += 1
+        if attempt >= RETRY_MAX_ATTEMPTS:
+            logger.error(f"Giving up on {operation} after {attempt} attempts: {error}")
+            if dead_letter is not None:
+                await run_storage(add_dead_letter, dict(
+                    dead_letter,
+                    operation=operation,
+                    error=str(error),
+                    failed_date=str(datetime.datetime.now())
+                ))
+            raise error
+        logger.warning(f"Retrying {operation} in {delay:.1f}s (attempt {attempt}): {error}")
+        await asyncio.sleep(delay)
+
+async def replay_dead_letter(bot: Bot, entry: Dict):
+    # Entries that fail again are dead-lettered again by call_with_retry.
+    # Approvals go through bot, deliveries through bulk_bot like the originals.
+    if entry['operation'] == 'approve':
+        await call_with_retry(
+            'approve', bot.approve_chat_join_request,
+            chat_id=entry['channel_id'], user_id=entry['user_id'],
+            dead_letter=entry
+        )
+        await run_storage(save_user, entry['user_id'], entry['username'], entry['first_name'],
+                          entry['last_name'], entry['channel_id'], entry['channel_title'])
+        welcome_queue.submit(entry['user_id'], entry['channel_title'])
+    else:
+        kwargs = dict(entry['kwargs'])
+        if kwargs.get('reply_markup'):
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], bulk_bot)
+        await call_with_retry(
+            entry['operation'], getattr(bulk_bot, entry['method']),
+            rate_limit_args={'priority': PRIORITY_BULK},
+            dead_letter=entry,
+            **kwargs
+        )
+
+# Join request outcomes: approved, failed for good, or out of retries (dead-lettered)
+approval_stats = {'approved': 0, 'failed': 0, 'exhausted': 0}
+
+async def process_join_request(bot: Bot, join_request: ChatJoinRequest):
+    user_id = join_request.from_user.id
+    username = join_request.from_user.username or "No username"
+    first_name = join_request.from_user.first_name or ""
+    last_name = join_request.from_user.last_name or ""
+    channel_id = join_request.chat.id
+    channel_title = join_request.chat.title or f"Channel {channel_id}"
     
     try:
         # Approve the join request
-        await update.chat_join_request.approve()
+        await call_with_retry(
+            'approve', bot.approve_chat_join_request,
+            chat_id=channel_id,
+            user_id=user_id,
+            rate_limit_args={'priority': PRIORITY_HIGH},
+            dead_letter={
+                'user_id': user_id,
+                'username': username,
+                'first_name': first_name,
+                'last_name': last_name,
+                'channel_id': channel_id,
+                'channel_title': channel_title
+            }
+        )
         
         # Log the approval
+        approval_stats['approved'] += 1
+        join_requests_approved.inc(channel_id)
+        approval_latency.observe(time.time() - join_request.date.timestamp())
         logger.info(f"Approved join request for user {user_id} (@{username}) in channel {channel_id} ({channel_title})")
         
         # Save user data
-        save_user(user_id, username, first_name, last_name, channel_id, channel_title)
+        await run_storage(save_user, user_id, username, first_name, last_name, channel_id, channel_title)
         
-        # Send approval notification
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ Your join request for *{channel_title}* has been approved!\n\nWelcome!",
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            logger.error(f"Could not send approval notification to user {user_id}: {e}")
+        # Queue the approval notification; it is sent in the background
+        welcome_queue.submit(user_id, channel_title)
             
     except Exception as e:
+        reason = 'exhausted' if classify_error(e).retryable else 'failed'
+        approval_stats[reason] += 1
+        join_requests_failed.inc(channel_id, reason)
         logger.error(f"Error approving user {user_id} for channel {channel_id}: {e}")
 
+class WelcomeQueue:
+    # Sends welcome DMs from a separate bounded queue with its own workers and
+    # rate budget, so a slow or rate-limited DM never holds up approvals.
+    # Notifications are dropped when the queue is full.
+    def __init__(self, workers: int, max_size: int, rate: float):
+        self.workers = workers
+        self.max_size = max_size
+        self.bucket = TokenBucket(rate, rate)
+        self.queue: Optional[asyncio.Queue] = None
+        self.sent = 0
+        self.failed = {'blocked': 0, 'deleted': 0, 'unsuccessful': 0}
+        self.dropped = 0
+
+    def start(self, bot: Bot):
+        self.queue = asyncio.Queue(self.max_size)
+        for i in range(self.workers):
+            start_background_task(self._worker(bot), name=f"welcome-worker-{i}")
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    def submit(self, user_id: int, channel_title: str):
+        try:
+            self.queue.put_nowait((user_id, channel_title))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            welcome_messages.inc('dropped')
+            logger.warning(f"Welcome queue full, dropped notification for user {user_id}")
+
+    async def _acquire(self):
+        while True:
+            wait = self.bucket.wait_time(time.monotonic())
+            if wait <= 0:
+                self.bucket.consume()
+                return
+            await asyncio.sleep(wait)
+
+    async def _worker(self, bot: Bot):
+        while True:
+            user_id, channel_title = await self.queue.get()
+            welcome_kwargs = {
+                'chat_id': user_id,
+                'text': f"✅ Your join request for *{channel_title}* has been approved!\n\nWelcome!",
+                'parse_mode': 'Markdown'
+            }
+            try:
+                await self._acquire()
+                await call_with_retry(
+                    'welcome', bot.send_message,
+                    rate_limit_args={'priority': PRIORITY_NORMAL},
+                    dead_letter={'method': 'send_message', 'kwargs': welcome_kwargs},
+                    **welcome_kwargs
+                )
+                self.sent += 1
+                welcome_messages.inc('sent')
+            except Exception as e:
+                result = classify_error(e)
+                self.failed[result.counter] += 1
+                welcome_messages.inc(result.counter)
+                if result.status:
+                    await run_storage(storage.set_reachability, [(user_id, result.status)])
+                logger.error(f"Could not send approval notification to user {user_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def drain(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping with {self.queue.qsize()} welcome messages still queued")
+
+welcome_queue = WelcomeQueue(WELCOME_WORKERS, WELCOME_QUEUE_SIZE, WELCOME_RATE_LIMIT)
+
+class ApprovalPipeline:
+    # Queues incoming join requests and approves them with a fixed number of
+    # concurrent workers. Storage writes stay serialized on the storage
+    # executor, and a duplicate request for the same user and channel is
+    # dropped while the first one is still pending.
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self.max_size = max_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.pending = set()
+
+    def start(self, bot: Bot):
+        self.queue = asyncio.Queue(self.max_size)
+        for i in range(self.workers):
+            start_background_task(self._worker(bot), name=f"approval-worker-{i}")
+
+    async def submit(self, join_request: ChatJoinRequest):
+        key = (join_request.from_user.id, join_request.chat.id)
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        await self.queue.put(join_request)
+
+    async def _worker(self, bot: Bot):
+        while True:
+            join_request = await self.queue.get()
+            try:
+                await process_join_request(bot, join_request)
+            finally:
+                self.pending.discard((join_request.from_user.id, join_request.chat.id))
+                self.queue.task_done()
+
+    async def drain(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping with {self.queue.qsize()} join requests still queued")
+
+approval_pipeline = ApprovalPipeline(APPROVAL_WORKERS, APPROVAL_QUEUE_SIZE)
+
+async def approve_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    join_requests_received.inc(update.chat_join_request.chat.id)
+    if worker_index is not None:
+        # A worker approves inline, so the update's queue row is only deleted
+        # once the approval is done and each user's requests stay in order
+        await process_join_request(context.bot, update.chat_join_request)
+        return
+    await approval_pipeline.submit(update.chat_join_request)
+
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Legacy Markdown: _ and [ in the command list are escaped
     await update.message.reply_text(
         "🤖 *Auto-Approval Bot*\n\n"
         "This bot automatically approves join requests in channels where it's an admin.\n\n"
         "Admin commands:\n"
-        "/broadcast - Send a broadcast message\n"
-        "/stats - Show broadcast statistics",
+        "/broadcast \\[channel\\_id ...] \\[union|intersection] - Send a broadcast message, optionally to channel members only\n"
+        "/stats - Show broadcast statistics\n"
+        "/replay - Retry failed approvals and deliveries\n"
+        "/export \\[csv|jsonl] - Export users and channels as gzip files\n"
+        "/import - Import users from a CSV or JSONL file\n"
+        "/addadmin <user\\_id> - Add an admin\n"
+        "/deladmin <user\\_id> - Remove an admin",
         parse_mode='Markdown'
     )
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
+    if not is_admin(user_id):
         await update.message.reply_text("🚫 You are not authorized to use this command.")
         return
     
+    # Optional audience: /broadcast <channel_id> ... [union|intersection]
+    args = list(context.args or [])
+    match = 'union'
+    if args and args[-1] in ('union', 'intersection'):
+        match = args.pop()
+    try:
+        channel_ids = [int(arg) for arg in args]
+    except ValueError:
+        await update.message.reply_text("Usage: /broadcast [channel_id ...] [union|intersection]")
+        return
+    
+    if channel_ids:
+        context.user_data['broadcast_target'] = (channel_ids, match)
+        await update.message.reply_text(
+            f"🎯 Broadcasting to members of {len(channel_ids)} channel(s) ({match})."
+        )
+    else:
+        context.user_data.pop('broadcast_target', None)
+    
     await update.message.reply_text(
         "📢 Please send the message you want to broadcast.\n\n"
         "You can include:\n"
         "- Text with Markdown formatting\n"
         "- A photo with caption\n"
         "- A message with buttons\n"
-        "- Other media types\n\n"
+        "- Videos, documents, audio, animations, polls, stickers and other media\n\n"
         "Send /cancel at any time to stop the broadcast.",
         parse_mode='Markdown'
     )
     
     # Set state to wait for broadcast message
+    context.user_data.pop('awaiting_import', None)
     context.user_data['awaiting_broadcast'] = True
 
 async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'broadcast_in_progress' in context.user_data:
-        context.user_data['broadcast_cancelled'] = True
+    job = active_broadcasts.get(update.effective_user.id)
+    if job is not None:
+        job.cancelled = True
         await update.message.reply_text("Broadcast cancelled. Partial results:")
-        await show_broadcast_stats(update, context)
+        await show_broadcast_stats(update.message, job.stats)
     elif 'awaiting_broadcast' in context.user_data:
         del context.user_data['awaiting_broadcast']
+        context.user_data.pop('broadcast_target', None)
         await update.message.reply_text("Broadcast preparation cancelled.")
+    elif 'awaiting_import' in context.user_data:
+        del context.user_data['awaiting_import']
+        await update.message.reply_text("Import cancelled.")
     else:
         await update.message.reply_text("No broadcast to cancel.")
 
-async def show_broadcast_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'broadcast_stats' not in context.user_data:
-        await update.message.reply_text("No broadcast statistics available.")
-        return
-    
-    stats = context.user_data['broadcast_stats']
-    stats_message = (
+def format_broadcast_stats(stats: Dict) -> str:
+    return (
         "📊 *Broadcast Progress*\n\n"
         f"◇ Total Users: {stats['total_users']}\n"
         f"◇ Successful: {stats['successful']}\n"
@@ -178,168 +1604,345 @@ async def show_broadcast_stats(update: Update, context: ContextTypes.DEFAULT_TYP
         f"◇ Deleted Accounts: {stats['deleted']}\n"
         f"◇ Unsuccessful: {stats['unsuccessful']}"
     )
-    
-    await update.message.reply_text(stats_message, parse_mode='Markdown')
+
+async def show_broadcast_stats(message: Message, stats: Dict):
+    await message.reply_text(format_broadcast_stats(stats), parse_mode='Markdown')
+
+# Content attributes checked in order to name a broadcast's message type
+MESSAGE_CONTENT_TYPES = [
+    'text', 'photo', 'video', 'animation', 'document', 'audio', 'voice',
+    'video_note', 'sticker', 'poll', 'location', 'venue', 'contact', 'dice'
+]
+
+def message_content_type(message: Message) -> str:
+    for content_type in MESSAGE_CONTENT_TYPES:
+        if getattr(message, content_type, None):
+            return content_type
+    return "other"
+
+# Built once and reused for every progress message
+CANCEL_BROADCAST_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Cancel Broadcast", callback_data="cancel_broadcast")]
+])
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+def reprobe_cutoff() -> str:
+    # Unreachable users whose last failure is older than this get tried again
+    return str(datetime.datetime.now() - datetime.timedelta(days=REPROBE_AFTER_DAYS))
+
+class BroadcastJob:
+    # A broadcast running as a background task, so update handling (and
+    # join request approval) carries on while it runs. Handlers find the
+    # running job in active_broadcasts to report progress or cancel it.
+    #
+    # The job record is checkpointed to storage every
+    # BROADCAST_CHECKPOINT_INTERVAL seconds and on shutdown. Recipients are
+    # sent to in user ID order; the record holds a cursor (every user ID up to
+    # it is done) plus the IDs past the cursor that are already done, so an
+    # unfinished job resumes at startup without sending anything twice.
+    def __init__(self, bot: Bot, record: Dict, recipients: Optional[List[int]] = None):
+        self.bot = bot
+        self.record = record
+        self.admin_id = record['admin_id']
+        self.stats = record['stats']
+        self.processed = record['processed']
+        self.cursor = record['cursor']
+        self.done_ahead = set(record['done_ahead'])
+        self.in_flight = set()
+        self.last_dispatched = self.cursor
+        self.recipients = recipients
+        self.reprobe_ids = set()
+        self.reachability_updates: List[Tuple[int, Optional[str]]] = []
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.start_processed = self.processed
+        self.progress_state = None
+        self.task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def create(cls, admin_id: int, message: Message, recipients: List[int], progress_msg: Message,
+               channel_ids: Optional[List[int]] = None, match: str = 'union') -> 'BroadcastJob':
+        record = {
+            'job_id': f"{message.chat_id}-{message.message_id}",
+            'admin_id': admin_id,
+            'channel_ids': channel_ids,
+            'match': match,
+            'chat_id': message.chat_id,
+            'message_id': message.message_id,
+            'reply_markup': message.reply_markup.to_dict() if message.reply_markup else None,
+            'message_type': message_content_type(message),
+            'progress_message_id': progress_msg.message_id,
+            'created_date': str(datetime.datetime.now()),
+            'stats': {
+                'total_users': len(recipients),
+                'successful': 0,
+                'blocked': 0,
+                'deleted': 0,
+                'unsuccessful': 0
+            },
+            'processed': 0,
+            'cursor': 0,
+            'done_ahead': []
+        }
+        return cls(bulk_bot, record, recipients)
+
+    def start(self):
+        active_broadcasts[self.admin_id] = self
+        self.task = start_background_task(self.run(), name=f"broadcast-{self.admin_id}")
+
+    async def run(self):
+        try:
+            if self.recipients is None:
+                # Resumed job: everyone after the cursor that isn't done yet
+                recipients = await run_storage(
+                    storage.get_broadcast_recipients, self.cursor, reprobe_cutoff(),
+                    self.record.get('channel_ids'), self.record.get('match', 'union')
+                )
+                self.recipients = [user_id for user_id in recipients if user_id not in self.done_ahead]
+                # The audience is recomputed, so users approved since the job
+                # started may be in it; count them in the total
+                self.stats['total_users'] = self.processed + len(self.recipients)
+            else:
+                await self._checkpoint()
+            # Unreachable users included for a re-probe are marked reachable again on success
+            self.reprobe_ids = set(await run_storage(storage.get_unreachable_ids)).intersection(self.recipients)
+            self.started = time.monotonic()
+            self.start_processed = self.processed
+            checkpoint_task = asyncio.create_task(self._checkpoint_loop())
+            progress_task = asyncio.create_task(self._progress_loop())
+            try:
+                await self._deliver()
+            finally:
+                checkpoint_task.cancel()
+                progress_task.cancel()
+            await self._finish()
+        except asyncio.CancelledError:
+            # Shutting down; save where we got to so the job resumes on restart
+            await self._checkpoint()
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {self.record['job_id']} failed: {e}")
+        finally:
+            active_broadcasts.pop(self.admin_id, None)
+
+    async def _save_reachability(self):
+        if self.reachability_updates:
+            updates, self.reachability_updates = self.reachability_updates, []
+            await run_storage(storage.set_reachability, updates)
+
+    async def _checkpoint(self):
+        await self._save_reachability()
+        if self.in_flight:
+            self.cursor = min(self.in_flight) - 1
+        else:
+            self.cursor = self.last_dispatched
+        self.done_ahead = {user_id for user_id in self.done_ahead if user_id > self.cursor}
+        self.record.update(
+            stats=dict(self.stats),
+            processed=self.processed,
+            cursor=self.cursor,
+            done_ahead=sorted(self.done_ahead)
+        )
+        await run_storage(storage.save_broadcast_job, dict(self.record))
+
+    async def _checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_INTERVAL)
+            try:
+                await self._checkpoint()
+            except Exception as e:
+                logger.error(f"Error checkpointing broadcast {self.record['job_id']}: {e}")
+
+    async def _deliver(self):
+        # Every recipient gets a server-side copy of the admin's message, so
+        # nothing is re-rendered per recipient and any content type works
+        send_kwargs = {'from_chat_id': self.record['chat_id'], 'message_id': self.record['message_id']}
+        reply_markup = None
+        if self.record['reply_markup']:
+            reply_markup = InlineKeyboardMarkup.de_json(self.record['reply_markup'], self.bot)
+        
+        # Fan the recipients out over concurrent workers sharing one iterator;
+        # the shared rate limiter keeps the overall pace within Telegram's limits
+        recipients = iter(self.recipients)
+        await asyncio.gather(*(
+            self._worker(recipients, send_kwargs, reply_markup)
+            for _ in range(min(BROADCAST_CONCURRENCY, len(self.recipients)))
+        ))
+
+    async def _worker(self, recipients, send_kwargs: Dict, reply_markup):
+        stats = self.stats
+        for recipient_id in recipients:
+            if self.cancelled:
+                break
+            
+            self.last_dispatched = recipient_id
+            self.in_flight.add(recipient_id)
+            try:
+                await call_with_retry(
+                    'broadcast', self.bot.copy_message,
+                    chat_id=recipient_id,
+                    reply_markup=reply_markup,
+                    rate_limit_args={'priority': PRIORITY_BULK},
+                    dead_letter={
+                        'method': 'copy_message',
+                        'kwargs': dict(send_kwargs, chat_id=recipient_id, reply_markup=self.record['reply_markup'])
+                    },
+                    **send_kwargs
+                )
+                
+                stats['successful'] += 1
+                broadcast_messages.inc('successful')
+                if recipient_id in self.reprobe_ids:
+                    self.reachability_updates.append((recipient_id, None))
+                
+            except Exception as e:
+                result = classify_error(e)
+                stats[result.counter] += 1
+                broadcast_messages.inc(result.counter)
+                if result.status:
+                    self.reachability_updates.append((recipient_id, result.status))
+                logger.error(f"Error sending to user {recipient_id}: {e}")
+            
+            # A send interrupted by shutdown stays in flight, holding the cursor back
+            self.in_flight.discard(recipient_id)
+            self.done_ahead.add(recipient_id)
+            self.processed += 1
+
+    async def _progress_loop(self):
+        # Edit the progress message on a fixed cadence rather than per message,
+        # and only when the counts changed; elapsed time, rate and ETA alone
+        # don't justify an edit while the broadcast is stalled
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            if self.cancelled:
+                # The cancel handlers have replaced the progress message
+                return
+            state = (self.processed, tuple(self.stats.values()))
+            if state == self.progress_state:
+                continue
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.record['chat_id'],
+                    message_id=self.record['progress_message_id'],
+                    text=self._progress_text(),
+                    reply_markup=CANCEL_BROADCAST_KEYBOARD
+                )
+                self.progress_state = state
+            except Exception as e:
+                logger.error(f"Error updating progress message: {e}")
+
+    def _progress_text(self) -> str:
+        stats = self.stats
+        total_users = stats['total_users']
+        percentage = int(self.processed / total_users * 100)
+        elapsed = time.monotonic() - self.started
+        # Rate over this run only, so a resumed job doesn't count earlier progress
+        rate = (self.processed - self.start_processed) / elapsed if elapsed > 0 else 0
+        eta = format_duration((total_users - self.processed) / rate) if rate > 0 else "unknown"
+        return (
+            f"📤 Broadcasting...\n"
+            f"{self.processed}/{total_users} ({percentage}%)\n\n"
+            f"✅ {stats['successful']} successful\n"
+            f"🚫 {stats['blocked'] + stats['deleted'] + stats['unsuccessful']} failed\n\n"
+            f"⚡ {rate:.1f} msg/s\n"
+            f"⏱ {format_duration(elapsed)} elapsed, ETA {eta}"
+        )
+
+    async def _finish(self):
+        await self._save_reachability()
+        
+        # Save broadcast stats if not cancelled
+        if not self.cancelled:
+            await run_storage(storage.save_broadcast, dict(
+                self.stats,
+                admin_id=self.admin_id,
+                message_type=self.record['message_type'],
+                sent_date=str(datetime.datetime.now())
+            ))
+        await run_storage(storage.delete_broadcast_job, self.record['job_id'])
+        
+        # Remove the cancel button from progress message
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.record['chat_id'],
+                message_id=self.record['progress_message_id'],
+                text=(
+                    f"📤 Broadcast {'cancelled' if self.cancelled else 'completed'}!\n"
+                    f"{self.processed} users processed"
+                ),
+                reply_markup=None
+            )
+        except Exception as e:
+            logger.error(f"Error updating final progress message: {e}")
+        
+        # Send broadcast summary
+        await self.bot.send_message(
+            chat_id=self.record['chat_id'],
+            text=format_broadcast_stats(self.stats),
+            parse_mode='Markdown'
+        )
+
+# Running broadcasts by admin user ID
+active_broadcasts: Dict[int, BroadcastJob] = {}
+
+async def resume_broadcasts(bot: Bot):
+    for record in await run_storage(storage.get_broadcast_jobs):
+        if record['admin_id'] in active_broadcasts:
+            continue
+        # Each worker resumes the jobs of the admins in its own partition
+        if worker_index is not None and record['admin_id'] % WORKER_PROCESSES != worker_index:
+            continue
+        logger.info(f"Resuming broadcast {record['job_id']} at {record['processed']}/{record['stats']['total_users']}")
+        BroadcastJob(bot, record).start()
 
 async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get('awaiting_broadcast', False):
         return
     
     user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
+    if not is_admin(user_id):
         return
     
     # Clear the preparation state
     del context.user_data['awaiting_broadcast']
     
-    # Get all users
-    users = read_json(USERS_FILE)
+    if user_id in active_broadcasts:
+        await update.message.reply_text("A broadcast is already running. Send /cancel to stop it first.")
+        return
+    
+    # Get all reachable users in the target audience
+    channel_ids, match = context.user_data.pop('broadcast_target', (None, 'union'))
+    users = await run_storage(storage.get_broadcast_recipients, 0, reprobe_cutoff(), channel_ids, match)
     
     if not users:
         await update.message.reply_text("No users in database to broadcast to.")
         return
     
-    total_users = len(users)
-    successful = 0
-    blocked = 0
-    deleted = 0
-    unsuccessful = 0
-    
-    # Store stats in user_data for cancellation
-    context.user_data['broadcast_stats'] = {
-        'total_users': total_users,
-        'successful': successful,
-        'blocked': blocked,
-        'deleted': deleted,
-        'unsuccessful': unsuccessful
-    }
-    context.user_data['broadcast_in_progress'] = True
-    context.user_data['broadcast_cancelled'] = False
-    
-    # Prepare the message based on type
-    message = update.message
-    reply_markup = message.reply_markup
-    
     # Send progress message
     progress_msg = await update.message.reply_text(
         "📤 Starting broadcast...\n"
-        f"0/{total_users} (0%)",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Cancel Broadcast", callback_data="cancel_broadcast")]
-        ])
+        f"0/{len(users)} (0%)",
+        reply_markup=CANCEL_BROADCAST_KEYBOARD
     )
     
-    # Send to each user
-    for i, user in enumerate(users):
-        if context.user_data.get('broadcast_cancelled', False):
-            break
-        
-        try:
-            if message.text:
-                await context.bot.send_message(
-                    chat_id=user['user_id'],
-                    text=message.text_markdown_v2,
-                    parse_mode='MarkdownV2',
-                    reply_markup=reply_markup
-                )
-            elif message.photo:
-                await context.bot.send_photo(
-                    chat_id=user['user_id'],
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption_markdown_v2 if message.caption else None,
-                    parse_mode='MarkdownV2',
-                    reply_markup=reply_markup
-                )
-            elif message.video:
-                await context.bot.send_video(
-                    chat_id=user['user_id'],
-                    video=message.video.file_id,
-                    caption=message.caption_markdown_v2 if message.caption else None,
-                    parse_mode='MarkdownV2',
-                    reply_markup=reply_markup
-                )
-            
-            successful += 1
-            
-        except Exception as e:
-            error_msg = str(e).lower()
-            if "blocked" in error_msg:
-                blocked += 1
-            elif "deleted" in error_msg or "not found" in error_msg:
-                deleted += 1
-            else:
-                unsuccessful += 1
-            logger.error(f"Error sending to user {user['user_id']}: {e}")
-        
-        # Update progress every 10 messages or last message
-        if i % 10 == 0 or i == len(users) - 1:
-            context.user_data['broadcast_stats'] = {
-                'total_users': total_users,
-                'successful': successful,
-                'blocked': blocked,
-                'deleted': deleted,
-                'unsuccessful': unsuccessful
-            }
-            
-            percentage = int((i + 1) / total_users * 100)
-            try:
-                await progress_msg.edit_text(
-                    f"📤 Broadcasting...\n"
-                    f"{i + 1}/{total_users} ({percentage}%)\n\n"
-                    f"✅ {successful} successful\n"
-                    f"🚫 {blocked + deleted + unsuccessful} failed",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("Cancel Broadcast", callback_data="cancel_broadcast")]
-                    ])
-                )
-            except Exception as e:
-                logger.error(f"Error updating progress message: {e}")
-    
-    # Clean up
-    del context.user_data['broadcast_in_progress']
-    
-    # Save broadcast stats if not cancelled
-    if not context.user_data.get('broadcast_cancelled', False):
-        broadcasts = read_json(BROADCASTS_FILE)
-        
-        message_type = "text"
-        if message.photo:
-            message_type = "photo"
-        elif message.video:
-            message_type = "video"
-        
-        broadcasts.append({
-            'admin_id': user_id,
-            'message_type': message_type,
-            'sent_date': str(datetime.datetime.now()),
-            'total_users': total_users,
-            'successful': successful,
-            'blocked': blocked,
-            'deleted': deleted,
-            'unsuccessful': unsuccessful
-        })
-        
-        write_json(BROADCASTS_FILE, broadcasts)
-    
-    # Remove the cancel button from progress message
-    try:
-        await progress_msg.edit_text(
-            "📤 Broadcast completed!\n"
-            f"{total_users} users processed",
-            reply_markup=None
-        )
-    except Exception as e:
-        logger.error(f"Error updating final progress message: {e}")
-    
-    # Send broadcast summary
-    await show_broadcast_stats(update, context)
+    # Deliver in the background so the handler returns immediately
+    BroadcastJob.create(user_id, update.message, users, progress_msg, channel_ids, match).start()
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     if query.data == "cancel_broadcast":
-        context.user_data['broadcast_cancelled'] = True
+        job = active_broadcasts.get(query.from_user.id)
+        if job is not None:
+            job.cancelled = True
         await query.edit_message_text(
             "Broadcast cancelled by admin.",
             reply_markup=None
@@ -347,58 +1950,575 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
+    if not is_admin(user_id):
         await update.message.reply_text("🚫 You are not authorized to use this command.")
         return
     
-    users = read_json(USERS_FILE)
-    channels = read_json(CHANNELS_FILE)
-    broadcasts = read_json(BROADCASTS_FILE)
+    data = await run_storage(storage.get_stats)
     
-    total_users = len(users)
-    total_channels = len(channels)
-    
-    if not broadcasts:
+    if not data['total_broadcasts']:
         stats_message = (
             "📊 *Bot Statistics*\n\n"
-            f"◇ Total Users: {total_users}\n"
-            f"◇ Total Channels: {total_channels}\n"
+            f"◇ Total Users: {data['total_users']}\n"
+            f"◇ Total Channels: {data['total_channels']}\n"
+            f"◇ Unreachable Users: {data['unreachable_users']}\n"
             "◇ No broadcasts sent yet"
         )
     else:
-        total_broadcasts = len(broadcasts)
-        total_recipients = sum(b['total_users'] for b in broadcasts)
-        total_successful = sum(b['successful'] for b in broadcasts)
-        total_blocked = sum(b['blocked'] for b in broadcasts)
-        total_deleted = sum(b['deleted'] for b in broadcasts)
-        total_unsuccessful = sum(b['unsuccessful'] for b in broadcasts)
-        
         stats_message = (
             "📊 *Bot Statistics*\n\n"
-            f"◇ Total Users: {total_users}\n"
-            f"◇ Total Channels: {total_channels}\n"
-            f"◇ Total Broadcasts: {total_broadcasts}\n"
-            f"◇ Total Recipients: {total_recipients}\n"
-            f"◇ Total Successful: {total_successful}\n"
-            f"◇ Total Blocked: {total_blocked}\n"
-            f"◇ Total Deleted: {total_deleted}\n"
-            f"◇ Total Unsuccessful: {total_unsuccessful}"
+            f"◇ Total Users: {data['total_users']}\n"
+            f"◇ Total Channels: {data['total_channels']}\n"
+            f"◇ Unreachable Users: {data['unreachable_users']}\n"
+            f"◇ Total Broadcasts: {data['total_broadcasts']}\n"
+            f"◇ Total Recipients: {data['total_recipients']}\n"
+            f"◇ Total Successful: {data['total_successful']}\n"
+            f"◇ Total Blocked: {data['total_blocked']}\n"
+            f"◇ Total Deleted: {data['total_deleted']}\n"
+            f"◇ Total Unsuccessful: {data['total_unsuccessful']}"
         )
     
+    if data['channels']:
+        stats_message += "\n\n*Users per Channel*"
+        for title, user_count in data['channels']:
+            stats_message += f"\n◇ {escape_markdown(title or '')}: {user_count}"
+        if data['total_channels'] > len(data['channels']):
+            stats_message += f"\n◇ ...and {data['total_channels'] - len(data['channels'])} more"
+        stats_message += "\n"
+    
+    stats_message += (
+        f"\n◇ Join Requests: {approval_stats['approved']} approved, "
+        f"{approval_stats['failed']} failed, {approval_stats['exhausted']} out of retries"
+    )
+    for job in active_broadcasts.values():
+        stats_message += (
+            f"\n◇ Running Broadcast: {job.processed}/{job.stats['total_users']} "
+            f"({job.stats['successful']} successful)"
+        )
+    stats_message += (
+        f"\n◇ Welcome Queue: {welcome_queue.depth()} pending, "
+        f"{welcome_queue.sent} sent, {sum(welcome_queue.failed.values())} failed "
+        f"({welcome_queue.failed['blocked']} blocked), {welcome_queue.dropped} dropped"
+    )
+    for pool in request_pools:
+        stats_message += (
+            f"\n◇ {pool.name.capitalize()} Pool: {pool.in_use}/{pool.pool_size} in use, "
+            f"wait avg {pool.wait_total / max(pool.requests, 1) * 1000:.1f} ms "
+            f"(max {pool.wait_max * 1000:.1f} ms)"
+        )
+    if worker_index is not None:
+        queued = await run_storage(update_queue.depth, worker_index)
+        stats_message += f"\n◇ Worker {worker_index + 1}/{WORKER_PROCESSES}: {queued} queued updates"
+    stats_message += f"\n◇ Event Loop Lag: {loop_lag.last * 1000:.1f} ms (max {loop_lag.max * 1000:.1f} ms)"
+    
     await update.message.reply_text(stats_message, parse_mode='Markdown')
 
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+async def run_replay(bot: Bot, admin_id: int, entries: List[Dict]):
+    successful = 0
+    for i, entry in enumerate(entries):
+        try:
+            await replay_dead_letter(bot, entry)
+            successful += 1
+        except asyncio.CancelledError:
+            # Shutting down; put back what wasn't replayed so the next /replay gets it
+            for remaining in entries[i:]:
+                await run_storage(add_dead_letter, remaining)
+            raise
+        except Exception as e:
+            logger.error(f"Error replaying {entry['operation']}: {e}")
+    
+    await bot.send_message(
+        chat_id=admin_id,
+        text="♻️ *Replay Finished*\n\n"
+             f"◇ Successful: {successful}\n"
+             f"◇ Failed: {len(entries) - successful}",
+        parse_mode='Markdown'
+    )
+
+async def replay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    
+    entries = await run_storage(take_dead_letters)
+    if not entries:
+        await update.message.reply_text("No failed operations to replay.")
+        return
+    
+    await update.message.reply_text(f"♻️ Replaying {len(entries)} failed operations...")
+    # Replay in the background so the handler returns immediately
+    start_background_task(run_replay(context.bot, user_id, entries), name=f"replay-{user_id}")
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+USER_EXPORT_COLUMNS = [
+    'user_id', 'username', 'first_name', 'last_name', 'join_date', 'status', 'last_failure', 'approved_channels'
+]
+CHANNEL_EXPORT_COLUMNS = ['channel_id', 'title', 'username', 'join_date', 'user_count']
+
+class ExportWriter:
+    # Writes rows to gzip-compressed CSV or JSONL files on disk. A part is
+    # finished before its compressed size reaches the upload limit, so each
+    # part can be sent as one document. In CSV, approved_channels is
+    # separated by semicolons.
+    part_size = UPLOAD_LIMIT - 1024 * 1024
+
+    def __init__(self, name: str, fmt: str, columns: List[str]):
+        self.name = name
+        self.fmt = fmt
+        self.columns = columns
+        self.part = 0
+        self.rows = 0
+        self.path = None
+        self.raw = None
+        self.file = None
+        self.csv = None
+
+    def _open(self):
+        self.part += 1
+        self.path = os.path.join(EXPORT_DIR, f"{self.name}-{self.part}.{self.fmt}.gz")
+        self.raw = open(self.path, 'wb')
+        self.file = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw, mode='wb'), encoding='utf-8', newline='')
+        if self.fmt == 'csv':
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(self.columns)
+
+    def write(self, rows: List[Dict]) -> List[str]:
+        # Returns the parts finished while writing these rows
+        finished = []
+        for row in rows:
+            if self.file is None:
+                self._open()
+            if self.fmt == 'csv':
+                self.csv.writerow([
+                    ';'.join(map(str, row[column])) if isinstance(row.get(column), list) else row.get(column)
+                    for column in self.columns
+                ])
+            else:
+                self.file.write(json.dumps({column: row.get(column) for column in self.columns}) + '\n')
+            self.rows += 1
+            if self.raw.tell() >= self.part_size:
+                finished.append(self.close())
+        return finished
+
+    def close(self) -> Optional[str]:
+        # Finishes the current part and returns its path
+        if self.file is None:
+            return None
+        self.file.close()
+        self.raw.close()
+        self.file = None
+        return self.path
+
+    def discard(self):
+        if self.file is not None:
+            self.close()
+            os.remove(self.path)
+
+async def send_export_part(bot: Bot, chat_id: int, path: str):
+    # A path is read from disk on every attempt; in local mode the Bot API
+    # server reads the file itself instead of receiving an upload
+    try:
+        await call_with_retry(
+            'export', bot.send_document,
+            chat_id=chat_id,
+            document=pathlib.Path(path).absolute(),
+            filename=os.path.basename(path),
+            write_timeout=EXPORT_UPLOAD_TIMEOUT
+        )
+    finally:
+        os.remove(path)
+
+async def export_table(bot: Bot, chat_id: int, name: str, fmt: str, columns: List[str], get_page, key: str) -> int:
+    # Streams one table from storage in EXPORT_PAGE_SIZE batches; only one
+    # batch and one part are held at a time
+    loop = asyncio.get_running_loop()
+    writer = ExportWriter(name, fmt, columns)
+    after = None
+    try:
+        while True:
+            page = await run_storage(get_page, after, EXPORT_PAGE_SIZE)
+            if not page:
+                break
+            after = page[-1][key]
+            for path in await loop.run_in_executor(None, writer.write, page):
+                await send_export_part(bot, chat_id, path)
+        path = await loop.run_in_executor(None, writer.close)
+        if path:
+            await send_export_part(bot, chat_id, path)
+    finally:
+        writer.discard()
+    return writer.rows
+
+active_exports: Set[int] = set()
+
+async def run_export(bot: Bot, admin_id: int, fmt: str):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    try:
+        users = await export_table(bot, admin_id, f"users-{admin_id}", fmt, USER_EXPORT_COLUMNS, storage.get_user_page, 'user_id')
+        channels = await export_table(bot, admin_id, f"channels-{admin_id}", fmt, CHANNEL_EXPORT_COLUMNS, storage.get_channel_page, 'channel_id')
+        await bot.send_message(
+            chat_id=admin_id,
+            text="📦 *Export Finished*\n\n"
+                 f"◇ Users: {users}\n"
+                 f"◇ Channels: {channels}",
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"Error exporting data for admin {admin_id}: {e}")
+        await bot.send_message(chat_id=admin_id, text=f"❌ Export failed: {e}")
+    finally:
+        active_exports.discard(admin_id)
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    
+    fmt = context.args[0].lower() if context.args else 'csv'
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("Usage: /export [csv|jsonl]")
+        return
+    if user_id in active_exports:
+        await update.message.reply_text("An export is already running.")
+        return
+    
+    await update.message.reply_text(f"📦 Exporting users and channels as gzip-compressed {fmt.upper()}...")
+    # Export in the background so the handler returns immediately
+    active_exports.add(user_id)
+    start_background_task(run_export(bulk_bot, user_id, fmt), name=f"export-{user_id}")
+
+def read_import_rows(path: str, counts: Dict[str, int]):
+    # Yields (user_id, username, first_name, last_name, channel_id, channel_title)
+    # rows from a CSV or JSONL file, gzip-compressed if the name ends in .gz.
+    # Each record has a channel_id, or approved_channels as written by /export.
+    name = path.lower()
+    compressed = name.endswith('.gz')
+    if compressed:
+        name = name[:-3]
+    jsonl = name.endswith(('.jsonl', '.json'))
+    with (gzip.open if compressed else open)(path, 'rt', encoding='utf-8', newline='') as f:
+        for record in (f if jsonl else csv.DictReader(f)):
+            try:
+                if jsonl:
+                    if not record.strip():
+                        continue
+                    record = json.loads(record)
+                user_id = int(record['user_id'])
+                if record.get('channel_id') not in (None, ''):
+                    channel_ids = [int(record['channel_id'])]
+                else:
+                    channels = record.get('approved_channels') or []
+                    if isinstance(channels, str):
+                        channels = [channel for channel in channels.split(';') if channel]
+                    channel_ids = [int(channel_id) for channel_id in channels]
+            except (KeyError, TypeError, ValueError, AttributeError):
+                counts['skipped'] += 1
+                continue
+            for channel_id in channel_ids:
+                yield (
+                    user_id,
+                    record.get('username') or None,
+                    record.get('first_name') or None,
+                    record.get('last_name') or None,
+                    channel_id,
+                    record.get('channel_title') or None
+                )
+
+async def import_file(path: str) -> Dict[str, int]:
+    # Parses the file off the event loop and merges it in batches of
+    # IMPORT_BATCH_SIZE rows, one storage job each, so approvals queued on
+    # the storage executor wait for at most one batch
+    loop = asyncio.get_running_loop()
+    counts = {'rows': 0, 'added': 0, 'skipped': 0}
+    rows = read_import_rows(path, counts)
+    while True:
+        batch = await loop.run_in_executor(None, list, itertools.islice(rows, IMPORT_BATCH_SIZE))
+        if not batch:
+            break
+        counts['added'] += await run_storage(storage.import_users, batch)
+        counts['rows'] += len(batch)
+    return counts
+
+async def run_import(bot: Bot, admin_id: int, path: str):
+    try:
+        counts = await import_file(path)
+        await bot.send_message(
+            chat_id=admin_id,
+            text="📥 *Import Finished*\n\n"
+                 f"◇ Rows: {counts['rows']}\n"
+                 f"◇ New Memberships: {counts['added']}\n"
+                 f"◇ Skipped: {counts['skipped']}",
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"Error importing {path} for admin {admin_id}: {e}")
+        await bot.send_message(chat_id=admin_id, text=f"❌ Import failed: {e}")
+    finally:
+        os.remove(path)
+
+async def import_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    
+    context.user_data.pop('awaiting_broadcast', None)
+    context.user_data['awaiting_import'] = True
+    await update.message.reply_text(
+        "📥 Please send the file to import.\n\n"
+        "CSV with a header row or JSONL, optionally gzip-compressed (.gz), with "
+        "user_id and channel_id, or approved_channels as written by /export. "
+        "username, first_name, last_name and channel_title are optional.\n\n"
+        "Send /cancel to abort."
+    )
+
+async def handle_import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.user_data.get('awaiting_import', False):
+        # Not an import; the document may be broadcast content
+        await handle_broadcast_message(update, context)
+        return
+    
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        return
+    
+    del context.user_data['awaiting_import']
+    document = update.message.document
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"import-{user_id}-{os.path.basename(document.file_name or 'users.csv')}")
+    try:
+        file = await document.get_file()
+        await file.download_to_drive(path)
+    except TelegramError as e:
+        await update.message.reply_text(f"❌ Could not download the file: {e}")
+        return
     
+    await update.message.reply_text(f"📥 Importing {document.file_name or 'file'}...")
+    # Import in the background so the handler returns immediately
+    start_background_task(run_import(context.bot, user_id, path), name=f"import-{user_id}")
+
+def import_cli(path: str):
+    # python auro_request_accept.py import <file>
+    if STORAGE_BACKEND != 'sqlite':
+        logger.warning("The bot must be stopped while importing into JSON storage, or it will overwrite the import")
+    counts = asyncio.run(import_file(path))
+    storage.close()
+    storage_executor.shutdown()
+    logger.info(
+        f"Imported {counts['rows']} rows from {path}: {counts['added']} new memberships, {counts['skipped']} skipped"
+    )
+
+async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    
+    try:
+        new_admin_id = int(context.args[0])
+    except (IndexError, TypeError, ValueError):
+        await update.message.reply_text("Usage: /addadmin <user_id>")
+        return
+    
+    if await run_storage(admins.add, new_admin_id):
+        logger.info(f"Admin {user_id} added admin {new_admin_id}")
+        await update.message.reply_text(f"✅ User {new_admin_id} is now an admin.")
+    else:
+        await update.message.reply_text(f"User {new_admin_id} is already an admin.")
+
+async def del_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("🚫 You are not authorized to use this command.")
+        return
+    
+    try:
+        old_admin_id = int(context.args[0])
+    except (IndexError, TypeError, ValueError):
+        await update.message.reply_text("Usage: /deladmin <user_id>")
+        return
+    
+    if admins.ids == {old_admin_id}:
+        await update.message.reply_text("🚫 Can't remove the last admin.")
+        return
+    
+    if await run_storage(admins.remove, old_admin_id):
+        logger.info(f"Admin {user_id} removed admin {old_admin_id}")
+        await update.message.reply_text(f"✅ User {old_admin_id} is no longer an admin.")
+    else:
+        await update.message.reply_text(f"User {old_admin_id} is not an admin.")
+
+def render_metrics() -> str:
+    # Gauges are sampled when scraped
+    approval_queue_depth.set(approval_pipeline.queue.qsize() if approval_pipeline.queue else 0)
+    welcome_queue_depth.set(welcome_queue.depth())
+    running_broadcasts.set(len(active_broadcasts))
+    for pool in request_pools:
+        http_requests.set(pool.requests, pool.name)
+        http_pool_wait.set(pool.wait_total, pool.name)
+        http_pool_in_use.set(pool.in_use, pool.name)
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Minimal HTTP/1.1: GET /metrics, one request per connection
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while await asyncio.wait_for(reader.readline(), 10) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render_metrics().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+metrics_server: Optional[asyncio.AbstractServer] = None
+
+async def on_startup(application: Application):
+    global bulk_bot, metrics_server
+    bulk_bot = ExtBot(
+        application.bot.token,
+        base_url=BOT_API_URL,
+        base_file_url=BOT_API_FILE_URL,
+        request=bulk_request,
+        local_mode=BOT_API_LOCAL,
+        rate_limiter=rate_limiter
+    )
+    await bulk_bot.initialize()
+    start_background_task(loop_lag.run(), name='loop-lag-monitor')
+    start_background_task(admins.run(), name='admins-reload')
+    if METRICS_PORT:
+        port = METRICS_PORT + (worker_index or 0)
+        metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+        logger.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+    approval_pipeline.start(application.bot)
+    welcome_queue.start(bulk_bot)
+    await resume_broadcasts(bulk_bot)
+
+async def on_stop(application: Application):
+    # Finish queued approvals and their notifications while the bot can still make requests
+    await approval_pipeline.drain(APPROVAL_DRAIN_TIMEOUT)
+    await welcome_queue.drain(APPROVAL_DRAIN_TIMEOUT)
+    await stop_background_tasks()
+    if metrics_server:
+        metrics_server.close()
+
+async def on_shutdown(application: Application):
+    # Flush pending writes before the process exits
+    if bulk_bot:
+        await bulk_bot.shutdown()
+    if update_queue:
+        await run_storage(update_queue.close)
+    await run_storage(storage.close)
+    storage_executor.shutdown()
+
+def update_partition(update: Update) -> int:
+    # Updates from the same user always go to the same worker
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = 0
+    return key % WORKER_PROCESSES
+
+async def enqueue_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await run_storage(update_queue.put, update_partition(update), json.dumps(update.to_dict()))
+
+async def run_worker(application: Application):
+    # Handles the updates queued for this worker's partition one at a time,
+    # in arrival order, until SIGINT or SIGTERM
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    logger.info(f"Worker {worker_index} started")
+    try:
+        while not stopping.is_set():
+            batch = await run_storage(update_queue.take, worker_index, UPDATE_BATCH_SIZE)
+            if not batch:
+                try:
+                    await asyncio.wait_for(stopping.wait(), UPDATE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for row_id, data in batch:
+                await application.process_update(Update.de_json(data, application.bot))
+            await run_storage(update_queue.ack, [row_id for row_id, data in batch])
+    finally:
+        await application.stop()
+        await on_stop(application)
+        await application.shutdown()
+        await on_shutdown(application)
+
+def run_worker_process(index: int):
+    global worker_index
+    worker_index = index
+    # The Bot API global limit is shared by all workers
+    rate = GLOBAL_RATE_LIMIT / WORKER_PROCESSES
+    rate_limiter.global_bucket = TokenBucket(rate, rate)
+    application = application_builder().updater(None).build()
+    add_handlers(application)
+    asyncio.run(run_worker(application))
+
+def start_workers() -> List[multiprocessing.Process]:
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for i in range(WORKER_PROCESSES):
+        process = context.Process(target=run_worker_process, args=(i,), name=f"worker-{i}")
+        process.start()
+        workers.append(process)
+    return workers
+
+def application_builder():
+    return (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .base_file_url(BOT_API_FILE_URL)
+        .local_mode(BOT_API_LOCAL)
+        .request(api_request)
+        .get_updates_request(updates_request)
+        .rate_limiter(rate_limiter)
+    )
+
+def add_handlers(application: Application):
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("broadcast", broadcast))
     application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CommandHandler("cancel", cancel_broadcast))
+    application.add_handler(CommandHandler("replay", replay))
+    application.add_handler(CommandHandler("export", export))
+    application.add_handler(CommandHandler("import", import_users))
+    application.add_handler(CommandHandler("addadmin", add_admin))
+    application.add_handler(CommandHandler("deladmin", del_admin))
+    
+    # Import files; other documents fall through to the broadcast handler
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_import_document))
     
     # Message handler for broadcast content
     application.add_handler(MessageHandler(
-        (filters.TEXT | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND,
+        ~filters.COMMAND,
         handle_broadcast_message
     ))
     
@@ -407,9 +2527,54 @@ def main():
     
     # Join request handler
     application.add_handler(ChatJoinRequestHandler(approve_user))
+
+def run_application(application: Application):
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+def main():
+    if not BOT_TOKEN:
+        raise ValueError("No BOT_TOKEN environment variable set")
+    
+    if WORKER_PROCESSES:
+        # This process only queues updates; the workers handle them
+        workers = start_workers()
+        application = application_builder().post_shutdown(on_shutdown).build()
+        application.add_handler(TypeHandler(Update, enqueue_update))
+        try:
+            run_application(application)
+        finally:
+            for process in workers:
+                process.terminate()
+            for process in workers:
+                process.join()
+        return
+    
+    application = (
+        application_builder()
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    add_handlers(application)
     
     # Start the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(application)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) == 3 and sys.argv[1] == 'import':
+        import_cli(sys.argv[2])
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,358 @@
+# End-to-end tests: updates are fed to Application.process_update (or posted
+# to the webhook, or queued for a worker) and HTTPXRequest.do_request is replaced by a fake Bot API
+# server in local mode, so handlers, the approval pipeline and broadcast jobs
+# run unchanged
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import httpx
+import pytest
+
+# The bot module reads its configuration and data files on import
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix='bot-test-'))
+os.environ.update(
+    BOT_TOKEN='123456:TEST',
+    BOT_API_URL='http://127.0.0.1:8081/bot',
+    BOT_API_FILE_URL='http://127.0.0.1:8081/file/bot',
+    BOT_API_LOCAL='true',
+    METRICS_PORT='0',
+    GLOBAL_RATE_LIMIT='1000',
+    CHAT_RATE_LIMIT='1000',
+    GROUP_RATE_LIMIT='60000',
+    WELCOME_RATE_LIMIT='1000',
+    RETRY_BASE_DELAY='0.01',
+    BROADCAST_CHECKPOINT_INTERVAL='0.05',
+    BROADCAST_PROGRESS_INTERVAL='0.05',
+    ADMINS_RELOAD_INTERVAL='0.05'
+)
+
+import auro_request_accept as bot_module
+from telegram import Update
+from telegram.request import HTTPXRequest
+
+ADMIN_ID = bot_module.ADMIN_IDS[0]
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+class FakeBotApi:
+    # Stand-in for a local telegram-bot-api server: answers calls to
+    # BOT_API_URL the way Telegram would and records them. copy_message fails
+    # for users in `blocked`; copy_message and approveChatJoinRequest for users
+    # in `held` wait on a future added to `waiting`. Documents are read from
+    # the path a local mode upload passes.
+    def __init__(self):
+        self.calls = []
+        self.delivered = []
+        self.documents = {}
+        self.blocked = set()
+        self.held = set()
+        self.waiting = []
+
+    def methods(self, endpoint: str):
+        return [params for method, params in self.calls if method == endpoint]
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        if not url.startswith(f"{bot_module.BOT_API_URL}{bot_module.BOT_TOKEN}/"):
+            return 404, json.dumps({'ok': False, 'error_code': 404, 'description': 'Not Found'}).encode()
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+        held_id = params.get('user_id') if endpoint == 'approveChatJoinRequest' else params.get('chat_id')
+        if endpoint in ('copyMessage', 'approveChatJoinRequest') and held_id in self.held:
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.append(future)
+            await future
+        if endpoint == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Test', 'username': 'test_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': params.get('message_id') or next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params['chat_id'], 'type': 'private'},
+                'text': params['text']
+            }
+        elif endpoint == 'copyMessage':
+            chat_id = params['chat_id']
+            if chat_id in self.blocked:
+                return 403, json.dumps({
+                    'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'
+                }).encode()
+            self.delivered.append(chat_id)
+            result = {'message_id': next(message_ids)}
+        elif endpoint == 'sendDocument':
+            path = params['document'].removeprefix('file://')
+            with open(path, 'rb') as f:
+                self.documents[os.path.basename(path)] = gzip.decompress(f.read()).decode()
+            result = {
+                'message_id': next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params['chat_id'], 'type': 'private'},
+                'document': {'file_id': path, 'file_unique_id': path}
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+@pytest.fixture
+def api(monkeypatch):
+    fake = FakeBotApi()
+    monkeypatch.setattr(HTTPXRequest, 'do_request', lambda self, *args, **kwargs: fake.do_request(*args, **kwargs))
+    return fake
+
+def run(scenario):
+    # Runs the bot around scenario(application) like main() does, without
+    # closing the shared storage
+    async def main():
+        application = bot_module.application_builder().build()
+        bot_module.add_handlers(application)
+        await application.initialize()
+        await bot_module.on_startup(application)
+        try:
+            await asyncio.wait_for(scenario(application), 30)
+        finally:
+            await bot_module.on_stop(application)
+            await bot_module.bulk_bot.shutdown()
+            await application.shutdown()
+    asyncio.run(main())
+
+async def wait_until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+def user_data(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+
+def join_request_data(user_id: int, channel_id: int) -> dict:
+    return {
+        'update_id': next(update_ids),
+        'chat_join_request': {
+            'chat': {'id': channel_id, 'type': 'channel', 'title': 'Test Channel'},
+            'from': user_data(user_id),
+            'user_chat_id': user_id,
+            'date': int(time.time())
+        }
+    }
+
+def message_data(user_id: int, text: str) -> dict:
+    message = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user_data(user_id),
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(update_ids), 'message': message}
+
+def callback_query_data(user_id: int, data: str, message_id: int) -> dict:
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': user_data(user_id),
+            'chat_instance': 'test',
+            'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}}
+        }
+    }
+
+def add_channel_members(channel_id: int, user_ids) -> list:
+    bot_module.storage.import_users([(user_id, None, None, None, channel_id, 'Test Channel') for user_id in user_ids])
+    return list(user_ids)
+
+async def start_broadcast(application, channel_id: int):
+    await application.process_update(Update.de_json(message_data(ADMIN_ID, f"/broadcast {channel_id}"), application.bot))
+    await application.process_update(Update.de_json(message_data(ADMIN_ID, "Hello"), application.bot))
+    return bot_module.active_broadcasts[ADMIN_ID]
+
+def test_join_request_is_approved_saved_and_welcomed(api):
+    async def scenario(application):
+        await application.process_update(Update.de_json(join_request_data(500001, -1001), application.bot))
+        await bot_module.approval_pipeline.queue.join()
+        await bot_module.welcome_queue.queue.join()
+
+    run(scenario)
+    assert api.methods('approveChatJoinRequest') == [{'chat_id': -1001, 'user_id': 500001}]
+    assert [params['chat_id'] for params in api.methods('sendMessage')] == [500001]
+    assert bot_module.storage.users[500001]['approved_channels'] == [-1001]
+
+def test_broadcast_skips_blocked_user_and_records_it(api):
+    recipients = add_channel_members(-1002, range(510001, 510011))
+    api.blocked = {510005}
+
+    async def scenario(application):
+        job = await start_broadcast(application, -1002)
+        await job.task
+
+    run(scenario)
+    assert sorted(api.delivered) == [user_id for user_id in recipients if user_id != 510005]
+    assert all(params['from_chat_id'] == ADMIN_ID for params in api.methods('copyMessage'))
+    assert bot_module.storage.users[510005]['status'] == 'blocked'
+    record = bot_module.storage.broadcasts[-1]
+    assert (record['total_users'], record['successful'], record['blocked']) == (10, 9, 1)
+
+    # The blocked user is left out of the next broadcast
+    api.calls.clear()
+    run(scenario)
+    assert sorted(params['chat_id'] for params in api.methods('copyMessage')) == [
+        user_id for user_id in recipients if user_id != 510005
+    ]
+
+def test_interrupted_broadcast_resumes_without_duplicates(api):
+    recipients = add_channel_members(-1003, range(520001, 520021))
+    api.held = set(recipients[10:])
+
+    async def scenario(application):
+        await start_broadcast(application, -1003)
+        await wait_until(lambda: len(api.delivered) == 10)
+        # Returning stops the bot, which checkpoints the job
+
+    run(scenario)
+    (record,) = [job for job in bot_module.storage.get_broadcast_jobs() if job['channel_ids'] == [-1003]]
+    assert record['processed'] == 10
+    assert record['cursor'] == recipients[9]
+
+    # Restart: on_startup resumes the job, including a user approved meanwhile
+    api.held.clear()
+    recipients += add_channel_members(-1003, [520021])
+
+    async def scenario(application):
+        job = bot_module.active_broadcasts.get(ADMIN_ID)
+        if job is not None:
+            await job.task
+
+    run(scenario)
+    assert sorted(api.delivered) == recipients
+    assert not bot_module.storage.get_broadcast_jobs()
+    record = bot_module.storage.broadcasts[-1]
+    assert (record['total_users'], record['successful']) == (21, 21)
+
+def test_cancelled_broadcast_keeps_its_cancelled_message(api):
+    recipients = add_channel_members(-1006, range(560001, 560007))
+    api.held = set(recipients)
+
+    async def scenario(application):
+        job = await start_broadcast(application, -1006)
+        await wait_until(lambda: len(api.waiting) == len(recipients))
+        await application.process_update(Update.de_json(
+            callback_query_data(ADMIN_ID, 'cancel_broadcast', job.record['progress_message_id']), application.bot
+        ))
+        # Sends still in flight finish over several progress intervals
+        for future in api.waiting[:3]:
+            future.set_result(None)
+        await asyncio.sleep(5 * bot_module.BROADCAST_PROGRESS_INTERVAL)
+        for future in api.waiting[3:]:
+            future.set_result(None)
+        await job.task
+
+    run(scenario)
+    texts = [params['text'] for params in api.methods('editMessageText')]
+    cancelled = texts.index("Broadcast cancelled by admin.")
+    assert not any(text.startswith("📤 Broadcasting") for text in texts[cancelled:])
+
+def test_webhook_rejects_updates_without_the_secret(api):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    async def scenario(application):
+        await application.start()
+        await application.updater.start_webhook(
+            listen='127.0.0.1',
+            port=port,
+            url_path=bot_module.WEBHOOK_PATH,
+            secret_token='s3cret',
+            allowed_updates=bot_module.ALLOWED_UPDATES
+        )
+        try:
+            url = f"http://127.0.0.1:{port}/{bot_module.WEBHOOK_PATH}"
+            async with httpx.AsyncClient() as client:
+                rejected = await client.post(url, json=join_request_data(530001, -1004),
+                                             headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+                accepted = await client.post(url, json=join_request_data(530002, -1004),
+                                             headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+            assert (rejected.status_code, accepted.status_code) == (403, 200)
+            await wait_until(lambda: api.methods('approveChatJoinRequest'))
+            await bot_module.approval_pipeline.queue.join()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+
+    run(scenario)
+    assert api.methods('setWebhook')[0]['allowed_updates'] == bot_module.ALLOWED_UPDATES
+    assert api.methods('approveChatJoinRequest') == [{'chat_id': -1004, 'user_id': 530002}]
+
+def test_export_passes_files_by_path_to_the_local_server(api):
+    add_channel_members(-1005, [540001, 540002])
+
+    async def scenario(application):
+        await application.process_update(Update.de_json(message_data(ADMIN_ID, "/export csv"), application.bot))
+        await wait_until(lambda: any('Export Finished' in params['text'] for params in api.methods('sendMessage')))
+
+    run(scenario)
+    assert all(params['document'].startswith('file://') for params in api.methods('sendDocument'))
+    users = api.documents[f"users-{ADMIN_ID}-1.csv.gz"].splitlines()
+    assert users[0].startswith('user_id,')
+    assert '540001,,,,' in '\n'.join(users)
+    assert not os.listdir(bot_module.EXPORT_DIR)
+
+def test_exhausted_pool_times_out(api, monkeypatch):
+    monkeypatch.setattr(bot_module, 'POOL_TIMEOUT', 0.05)
+    request = bot_module.PooledRequest('test', 1)
+
+    async def main():
+        await request.slots.acquire()
+        with pytest.raises(bot_module.TimedOut):
+            await request.do_request(f"{bot_module.BOT_API_URL}{bot_module.BOT_TOKEN}/getMe", 'POST')
+        request.slots.release()
+        assert await request.do_request(f"{bot_module.BOT_API_URL}{bot_module.BOT_TOKEN}/getMe", 'POST')
+
+    asyncio.run(main())
+
+def test_admins_file_changes_apply_without_a_restart(api):
+    async def scenario(application):
+        await bot_module.run_storage(bot_module.write_json, bot_module.ADMINS_FILE, [ADMIN_ID, 550001])
+        await wait_until(lambda: bot_module.is_admin(550001))
+        await bot_module.run_storage(bot_module.write_json, bot_module.ADMINS_FILE, [])
+        await wait_until(lambda: not bot_module.is_admin(550001))
+
+    run(scenario)
+    assert bot_module.is_admin(ADMIN_ID)
+
+def test_worker_deletes_a_join_request_only_once_approved(api, monkeypatch, tmp_path):
+    queue = bot_module.UpdateQueue(str(tmp_path / 'updates.db'))
+    monkeypatch.setattr(bot_module, 'update_queue', queue)
+    monkeypatch.setattr(bot_module, 'worker_index', 0)
+    monkeypatch.setattr(bot_module, 'WORKER_PROCESSES', 1)
+    # Keep the shared storage open for the other tests
+    monkeypatch.setattr(bot_module, 'on_shutdown', lambda application: bot_module.bulk_bot.shutdown())
+    api.held = {570001}
+    queue.put(0, json.dumps(join_request_data(570001, -1007)))
+
+    async def drive():
+        await wait_until(lambda: api.waiting)
+        await asyncio.sleep(0.1)
+        assert queue.depth(0) == 1
+        api.waiting[0].set_result(None)
+        await wait_until(lambda: queue.depth(0) == 0)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    async def main():
+        application = bot_module.application_builder().updater(None).build()
+        bot_module.add_handlers(application)
+        await asyncio.wait_for(asyncio.gather(bot_module.run_worker(application), drive()), 30)
+
+    asyncio.run(main())
+    queue.close()
+    assert api.methods('approveChatJoinRequest') == [{'chat_id': -1007, 'user_id': 570001}]
+    assert -1007 in bot_module.storage.users[570001]['approved_channels']